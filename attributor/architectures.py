@@ -0,0 +1,159 @@
+import hashlib
+import os
+from dataclasses import dataclass, field
+from functools import partial
+from os import PathLike
+from typing import Callable
+
+import torch
+
+from attributor import get_logger
+from attributor.utils import atomic_write
+
+logger = get_logger()
+
+DEFAULT_CACHE_DIRPATH = os.environ.get(
+    "ATTRIBUTOR_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "attributor")
+)
+
+
+@dataclass(frozen=True)
+class Architecture:
+    attention_modules: Callable[[torch.nn.Module], list[torch.nn.Module]] = field(kw_only=True)
+    """The attention module of every layer."""
+    output_projections: Callable[[torch.nn.Module], list[torch.Tensor]] = field(kw_only=True)
+    """The weight of every layer's attention output projection, as [hidden, heads * head_dim]."""
+    recompute_attention: bool = field(default=False, kw_only=True)
+    """Whether attention modules have q_proj, k_proj and rotary embeddings so attention can be recomputed."""
+
+
+ARCHITECTURES: dict[str, Architecture] = {}
+
+
+def register_architecture(model_type: str, architecture: Architecture):
+    ARCHITECTURES[model_type] = architecture
+
+
+def get_architecture(model) -> Architecture:
+    model_type = getattr(model.config, "model_type", None)
+    if model_type not in ARCHITECTURES:
+        raise NotImplementedError(type(model).__name__)
+    return ARCHITECTURES[model_type]
+
+
+for model_type in ("llama", "mistral", "qwen2"):
+    register_architecture(
+        model_type,
+        Architecture(
+            attention_modules=lambda model: [layer.self_attn for layer in model.model.layers],
+            output_projections=lambda model: [
+                layer.self_attn.o_proj.weight for layer in model.model.layers
+            ],
+            recompute_attention=True,
+        ),
+    )
+
+register_architecture(
+    "phi",
+    Architecture(
+        attention_modules=lambda model: [layer.self_attn for layer in model.model.layers],
+        output_projections=lambda model: [
+            layer.self_attn.dense.weight for layer in model.model.layers
+        ],
+    ),
+)
+
+register_architecture(
+    "gpt2",
+    Architecture(
+        attention_modules=lambda model: [block.attn for block in model.transformer.h],
+        # c_proj is a Conv1D, which stores its weight as [in, out]
+        output_projections=lambda model: [
+            block.attn.c_proj.weight.T for block in model.transformer.h
+        ],
+    ),
+)
+
+register_architecture(
+    "gpt_neox",
+    Architecture(
+        attention_modules=lambda model: [layer.attention for layer in model.gpt_neox.layers],
+        output_projections=lambda model: [
+            layer.attention.dense.weight for layer in model.gpt_neox.layers
+        ],
+    ),
+)
+
+
+def attention_weights_index(output: tuple) -> int:
+    """
+    Index of the attention weights in the outputs of an attention module, which are either
+    (hidden_states, attention, ...) or (hidden_states, present, attention).
+    """
+    for i, value in enumerate(output[1:], 1):
+        if isinstance(value, torch.Tensor) and len(value.shape) == 4:
+            return i
+    raise ValueError("Attention module didn't return attention weights")
+
+
+def compute_attention_head_weights(model) -> list[torch.Tensor]:
+    """The normalized Frobenius norm of each head's output projection, as [heads, 1, 1] per layer"""
+    output_projections = get_architecture(model).output_projections(model)
+    per_head_output_projections = [o_proj.reshape(model.config.num_attention_heads, -1, o_proj.shape[-1]) for o_proj in output_projections]
+    attention_head_weights = [torch.linalg.matrix_norm(o_proj.type(torch.float32), dim=[1,2]).unsqueeze(-1).unsqueeze(-1) for o_proj in per_head_output_projections]
+    return [a / a.sum() for a in attention_head_weights]
+
+
+def model_fingerprint(model, output_projections: list[torch.Tensor] | None = None) -> str:
+    """A filename-safe id of model from its name, revision and a sample of its weights"""
+    if output_projections is None:
+        output_projections = get_architecture(model).output_projections(model)
+    name = getattr(model.config, "_name_or_path", "") or type(model).__name__
+    revision = getattr(model.config, "_commit_hash", None)
+
+    digest = hashlib.sha256(f"{name}@{revision}".encode())
+    for o_proj in output_projections:
+        digest.update(f"{tuple(o_proj.shape)}{o_proj.dtype}".encode())
+        # A strided sample of the weights tells fine-tunes of the same model apart without
+        # reading (or copying) all of them
+        sample = o_proj[:: max(1, o_proj.shape[0] // 64), :: max(1, o_proj.shape[1] // 64)]
+        digest.update(sample.detach().type(torch.float32).cpu().numpy().tobytes())
+
+    return f"{name.strip('/').replace('/', '--')}-{digest.hexdigest()[:16]}"
+
+
+def _cache_filepath(model, output_projections: list[torch.Tensor], cache_dirpath: PathLike):
+    filename = f"{model_fingerprint(model, output_projections)}.pt"
+    return os.path.join(cache_dirpath, "attention_head_weights", filename)
+
+
+def get_attention_head_weights(
+    model, cache_dirpath: PathLike | None = DEFAULT_CACHE_DIRPATH
+) -> list[torch.Tensor]:
+    """
+    The attention head weights of every layer of model, loaded from cache_dirpath if they were
+    computed before. Pass cache_dirpath=None to always compute them.
+    """
+    if cache_dirpath is None:
+        return compute_attention_head_weights(model)
+
+    output_projections = get_architecture(model).output_projections(model)
+    cache_filepath = _cache_filepath(model, output_projections, cache_dirpath)
+
+    if os.path.exists(cache_filepath):
+        logger.debug(f"Loading attention head weights from {cache_filepath}.")
+        attention_head_weights = torch.load(cache_filepath, map_location="cpu")
+        return [
+            a.to(o_proj.device) for a, o_proj in zip(attention_head_weights, output_projections)
+        ]
+
+    attention_head_weights = compute_attention_head_weights(model)
+
+    logger.debug(f"Saving attention head weights to {cache_filepath}.")
+    os.makedirs(os.path.dirname(cache_filepath), exist_ok=True)
+    atomic_write(
+        cache_filepath,
+        partial(torch.save, [a.cpu() for a in attention_head_weights]),
+    )
+
+    return attention_head_weights
@@ -0,0 +1,145 @@
+import functools
+import hashlib
+import math
+import os
+from os import PathLike
+
+import numpy as np
+import torch
+
+from attributor import get_logger
+from attributor.architectures import DEFAULT_CACHE_DIRPATH, model_fingerprint
+from attributor.utils import atomic_write
+
+logger = get_logger()
+
+
+@functools.lru_cache(maxsize=4)
+def _tril(n: int, device) -> tuple[torch.Tensor, torch.Tensor]:
+    """The row and column indices of the lower triangle of [n, n], for the last few n"""
+    return tuple(torch.tril_indices(n, n, device=device))
+
+
+class AttentionCache:
+    """
+    The attention of every layer of model over token sequences, cached on local disk and keyed
+    by the model's fingerprint and a hash of the tokens.
+
+    By default the head-reduced [len, len] attention is stored, which only serves the model's
+    own head weights. With per_head, the raw [heads, len, len] attention is stored instead,
+    which serves any head weights at heads times the size.
+
+    Attention is causal, so only the lower triangle is stored, as float16, in one .npy file per
+    sequence that is memory-mapped when read. Once the files take more than max_bytes, the
+    least recently used ones are evicted.
+    """
+
+    def __init__(
+        self,
+        model,
+        cache_dirpath: PathLike = DEFAULT_CACHE_DIRPATH,
+        max_bytes: int = 64 * 2**30,
+        per_head: bool = False,
+    ):
+        self.per_head = per_head
+        self.max_bytes = max_bytes
+        self.root_dirpath = os.path.join(cache_dirpath, "attentions")
+        self.dirpath = os.path.join(
+            self.root_dirpath, model_fingerprint(model), "heads" if per_head else "reduced"
+        )
+        os.makedirs(self.dirpath, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+        self._size = sum(size for _, _, size in self._files())
+
+    def _files(self):
+        """(last use, filepath, size) of every cached file of every model"""
+        for dirpath, _, filenames in os.walk(self.root_dirpath):
+            for filename in filenames:
+                if not filename.endswith(".npy"):
+                    continue
+                filepath = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(filepath)
+                except FileNotFoundError:
+                    # Evicted by another process
+                    continue
+                yield stat.st_mtime, filepath, stat.st_size
+
+    def _filepath(self, tokens: torch.Tensor) -> str:
+        digest = hashlib.sha256(tokens.detach().cpu().type(torch.int64).numpy().tobytes())
+        digest = digest.hexdigest()
+        return os.path.join(self.dirpath, digest[:2], f"{digest}.npy")
+
+    def get(self, tokens: torch.Tensor, device=None) -> list[torch.Tensor] | None:
+        """
+        The attention of every layer for the [len] tokens, as [len, len] or [1, heads, len, len]
+        float32 on device, or None if it isn't cached.
+        """
+        filepath = self._filepath(tokens)
+        try:
+            packed = np.load(filepath, mmap_mode="r")
+            # Reading a file makes it the most recently used
+            os.utime(filepath)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+
+        n = tokens.shape[-1]
+        rows, columns = _tril(n, device)
+        attentions = []
+        for layer in packed:
+            values = torch.from_numpy(np.ascontiguousarray(layer)).to(device).type(torch.float32)
+            A = torch.zeros(*values.shape[:-1], n, n, dtype=torch.float32, device=device)
+            A[..., rows, columns] = values
+            if self.per_head:
+                attentions.append(A.unsqueeze(0))
+            else:
+                # Undo the rounding to float16
+                A /= A.sum(axis=-1, keepdim=True)
+                attentions.append(A)
+        return attentions
+
+    def put(self, tokens: torch.Tensor, attentions: list[torch.Tensor]):
+        """Cache the attention of every layer for the [len] tokens, as returned by get"""
+        n = tokens.shape[-1]
+        rows, columns = _tril(n, attentions[0].device)
+        packed = np.stack(
+            [
+                A.squeeze(0)[..., rows, columns].type(torch.float16).cpu().numpy()
+                for A in attentions
+            ]
+        )
+
+        filepath = self._filepath(tokens)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+
+        def write(temporary_filepath: str):
+            # np.save would add .npy to a path
+            with open(temporary_filepath, "wb") as fd:
+                np.save(fd, packed)
+
+        atomic_write(filepath, write)
+
+        self._size += os.path.getsize(filepath)
+        if self._size > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        # Evict down to 90% of the cap so that not every put has to list the files
+        files = sorted(self._files())
+        self._size = sum(size for _, _, size in files)
+        target = math.floor(0.9 * self.max_bytes)
+        evicted = 0
+        for _, filepath, size in files:
+            if self._size <= target:
+                break
+            try:
+                os.remove(filepath)
+            except FileNotFoundError:
+                pass
+            self._size -= size
+            evicted += 1
+        logger.debug(f"Evicted {evicted} cached attentions.")
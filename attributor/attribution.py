@@ -1,16 +1,62 @@
+from bisect import bisect_left
+
 import torch
 
-from attributor.attribution_span import AttributionSpan
+from attributor.attribution_span import AttributionSpan, AttributionSpans
 from attributor.span import Span
-from attributor.utils import find
+from attributor.utils import TokenIndex, find_spans
 
 
 class Attribution:
-    def __init__(self, model, tokenizer, tokens, attributions):
+    def __init__(
+        self, model, tokenizer, tokens, attributions, output_indices=None, error_bounds=None
+    ):
         self.model = model
         self.tokenizer = tokenizer
         self.tokens = tokens
-        self.attributions = attributions
+        # A tensor, or a function that loads it the first time it is needed
+        self._attributions = attributions
+        # If only some output rows were computed, row i of attributions is output output_indices[i]
+        self.output_indices = (
+            None if output_indices is None else torch.as_tensor(output_indices).cpu()
+        )
+        # Upper bound on the L1 error of each row of attributions, if it is approximate
+        self.error_bounds = error_bounds
+        self._table = None
+        self._token_index = None
+
+    @property
+    def attributions(self) -> torch.Tensor:
+        if callable(self._attributions):
+            self._attributions = self._attributions()
+        return self._attributions
+
+    @attributions.setter
+    def attributions(self, attributions: torch.Tensor):
+        self._attributions = attributions
+        self._table = None
+
+    def _output_rows(self, output_span: Span) -> slice:
+        """Rows of self.attributions covering the outputs in output_span"""
+        if self.output_indices is None:
+            return slice(output_span.start, output_span.end)
+
+        output_indices = self.output_indices.tolist()
+        start = 0 if output_span.start is None else bisect_left(output_indices, output_span.start)
+        end = None if output_span.end is None else bisect_left(output_indices, output_span.end)
+        return slice(start, end)
+
+    def _output_start(self, output_span: Span) -> int:
+        """Index of the first output in output_span that has a row in self.attributions"""
+        if self.output_indices is None:
+            return output_span.start or 0
+        return int(self.output_indices[self._output_rows(output_span).start])
+
+    def _output_end(self, output_span: Span) -> int:
+        if self.output_indices is None:
+            return output_span.end or self.attributions.shape[0]
+        rows = self._output_rows(output_span)
+        return int(self.output_indices[: rows.stop][-1]) + 1
 
     def imshow(
         self,
@@ -30,37 +76,72 @@ class Attribution:
         attributions = attributions.cpu()
         plt.imshow(attributions)
 
-    def _rolling_mean(
-        self, *, attributions: torch.Tensor, output_span: Span, input_span: Span
+    def _summed_area_table(self, ignore_inputs: torch.Tensor = None) -> torch.Tensor:
+        """
+        S[i, j] = attributions[:i, :j].sum(), so the sum over any rectangle of attributions is
+        four lookups. It is built the first time it is needed, or every time if inputs are
+        ignored.
+        """
+        if ignore_inputs is None and self._table is not None:
+            return self._table
+
+        # Sums get large, keep windows that are far from the origin accurate
+        attributions = self.attributions.to(device="cpu", dtype=torch.float64, copy=True)
+        if ignore_inputs is not None:
+            attributions[:, torch.as_tensor(ignore_inputs).cpu()] = 0
+
+        table = torch.zeros(attributions.shape[0] + 1, attributions.shape[1] + 1, dtype=torch.float64)
+        table[1:, 1:] = attributions.cumsum(0).cumsum(1)
+
+        if ignore_inputs is None:
+            self._table = table
+        return table
+
+    def _rectangle_sums(self, table, output_start, output_end, input_start, input_end):
+        return (
+            table[output_end, input_end]
+            - table[output_start, input_end]
+            - table[output_end, input_start]
+            + table[output_start, input_start]
+        )
+
+    def _bounds(self, output_span: Span, input_span: Span):
+        """Rows and columns of self.attributions covered by output_span and input_span"""
+        output_start, output_end, _ = self._output_rows(output_span).indices(
+            self.attributions.shape[0]
+        )
+        input_start, input_end, _ = slice(input_span.start, input_span.end).indices(
+            self.attributions.shape[1]
+        )
+        return output_start, output_end, input_start, input_end
+
+    def _rolling_sum(
+        self,
+        *,
+        output_span: Span,
+        input_span: Span,
+        ignore_inputs: torch.Tensor = None,
     ):
-        output_length = attributions.shape[0]
-        input_length = attributions.shape[1]
-
-        rolling = [
-            torch.stack(
-                [
-                    attributions[
-                        i : i + output_span.window_size,
-                        j : j + input_span.window_size,
-                    ]
-                    for j in range(
-                        0,
-                        input_length - input_span.window_size + 1,
-                        input_span.step,
-                    )
-                ],
-                axis=0,
-            )
-            for i in range(
-                0, output_length - output_span.window_size + 1, output_span.step
-            )
-        ]
-        rolling = torch.stack(rolling, axis=0)
-        # total attribution in each window
-        rolling = rolling.sum(axis=(-1, -2))
-        # normalize each output's input distrubtion
-        # rolling /= rolling.sum(axis=-1, keepdims=True)
-        return rolling
+        """
+        The total attribution of every (output window, input window) pair, as
+        [output windows, input windows]
+        """
+        output_start, output_end, input_start, input_end = self._bounds(output_span, input_span)
+
+        output_starts = torch.arange(
+            output_start, output_end - output_span.window_size + 1, output_span.step
+        ).unsqueeze(-1)
+        input_starts = torch.arange(
+            input_start, input_end - input_span.window_size + 1, input_span.step
+        ).unsqueeze(0)
+
+        return self._rectangle_sums(
+            self._summed_area_table(ignore_inputs),
+            output_starts,
+            output_starts + output_span.window_size,
+            input_starts,
+            input_starts + input_span.window_size,
+        )
 
     def _slice_attributions(
         self,
@@ -72,16 +153,6 @@ class Attribution:
         input_span = input_span or Span()
         output_span = output_span or Span()
 
-        attributions = torch.clone(self.attributions)
-
-        if ignore_inputs is not None:
-            attributions[:, ignore_inputs] = 0
-
-        attributions = attributions[
-            slice(output_span.start, output_span.end),
-            slice(input_span.start, input_span.end),
-        ]
-
         if (
             output_span.window_size
             * output_span.step
@@ -89,11 +160,22 @@ class Attribution:
             * input_span.step
             != 1
         ):
-            attributions = self._rolling_mean(
-                attributions=attributions,
+            rolling = self._rolling_sum(
                 output_span=output_span,
                 input_span=input_span,
+                ignore_inputs=ignore_inputs,
             )
+            return rolling.to(device=self.attributions.device, dtype=self.attributions.dtype)
+
+        inputs = slice(input_span.start, input_span.end)
+        attributions = self.attributions[self._output_rows(output_span), inputs].clone()
+
+        if ignore_inputs is not None:
+            ignored = torch.zeros(
+                self.attributions.shape[1], dtype=torch.bool, device=attributions.device
+            )
+            ignored[ignore_inputs] = True
+            attributions[:, ignored[inputs]] = 0
 
         return attributions
 
@@ -108,7 +190,7 @@ class Attribution:
         input_span = input_span or Span()
         output_span = output_span or Span()
 
-        output_start = output_span.start or 0
+        output_start = self._output_start(output_span)
         input_start = input_span.start or 0
 
         spans = []
@@ -205,47 +287,145 @@ class Attribution:
         else:
             input_spans = input_spans or Span()
 
-            attributions = self._slice_attributions(
-                output_span=output_span,
-                input_span=input_spans,
-                ignore_inputs=ignore_inputs,
-            )
+            if (
+                output_span.window_size
+                * output_span.step
+                * input_spans.window_size
+                * input_spans.step
+                != 1
+            ):
+                attribution = self._rolling_sum(
+                    output_span=output_span,
+                    input_span=input_spans,
+                    ignore_inputs=ignore_inputs,
+                ).sum()
+            else:
+                attribution = self._rectangle_sums(
+                    self._summed_area_table(ignore_inputs),
+                    *self._bounds(output_span, input_spans),
+                )
 
-            output_start = output_span.start or 0
+            output_start = self._output_start(output_span)
             input_start = input_spans.start or 0
 
-            output_end = output_span.end or self.attributions.shape[0]
+            output_end = self._output_end(output_span)
             input_end = input_spans.end or self.attributions.shape[1]
 
             return AttributionSpan(
                 output_indices=list(range(output_start, output_end)),
                 input_indices=list(range(input_start, input_end)),
-                attribution=float(attributions.sum().cpu()),
+                attribution=float(attribution),
             )
 
-    def sort(self, output_span: Span, candidate_documents: list[str]):
-        candidate_spans = []
-        tokens_cpu = self.tokens.cpu()
-        for sentence in candidate_documents:
-            sentence_tokens = self.tokenizer.encode(sentence)
-            start, score = find(tokens_cpu, sentence_tokens)
-            if start >= 0:
-                end = start + len(sentence_tokens)
-                candidate_spans.append(
-                    Span(start=start, end=end, step=1, window_size=len(sentence_tokens))
-                )
-            else:
-                print(f"WARNING! Couldn't find document {sentence} in tokens")
-        attribution_spans = self.get(
-            output_span=output_span, input_spans=candidate_spans
+    def get_many(
+        self,
+        *,
+        input_starts: torch.Tensor,
+        input_ends: torch.Tensor,
+        output_starts: torch.Tensor = None,
+        output_ends: torch.Tensor = None,
+        ignore_inputs: torch.Tensor = None,
+    ) -> AttributionSpans:
+        """
+        Total attribution of every output span [output_starts[i], output_ends[i]) to every input
+        span [input_starts[j], input_ends[j]), as [outputs, inputs] columns. Without output spans
+        all outputs form one span.
+        """
+        rows, columns = self.attributions.shape
+        if output_starts is None:
+            output_starts = torch.tensor([self._output_start(Span())])
+        if output_ends is None:
+            output_ends = torch.tensor([self._output_end(Span())])
+
+        output_starts, output_ends = (
+            torch.as_tensor(output_starts).cpu().unsqueeze(-1),
+            torch.as_tensor(output_ends).cpu().unsqueeze(-1),
+        )
+        input_starts, input_ends = (
+            torch.as_tensor(input_starts).cpu().unsqueeze(0),
+            torch.as_tensor(input_ends).cpu().unsqueeze(0),
+        )
+
+        # Outputs are rows of self.attributions, which may not start at output 0
+        if self.output_indices is None:
+            output_start_rows, output_end_rows = output_starts, output_ends
+        else:
+            output_start_rows = torch.searchsorted(self.output_indices, output_starts)
+            output_end_rows = torch.searchsorted(self.output_indices, output_ends)
+
+        attributions = self._rectangle_sums(
+            self._summed_area_table(ignore_inputs),
+            output_start_rows.clamp(0, rows),
+            output_end_rows.clamp(0, rows),
+            input_starts.clamp(0, columns),
+            input_ends.clamp(0, columns),
+        )
+
+        output_starts, output_ends, input_starts, input_ends = torch.broadcast_tensors(
+            output_starts, output_ends, input_starts, input_ends
+        )
+        return AttributionSpans(
+            output_starts=output_starts,
+            output_ends=output_ends,
+            input_starts=input_starts,
+            input_ends=input_ends,
+            attributions=attributions,
+        )
+
+    def top_k_many(
+        self,
+        *,
+        input_starts: torch.Tensor,
+        input_ends: torch.Tensor,
+        output_starts: torch.Tensor = None,
+        output_ends: torch.Tensor = None,
+        top_k: int = 3,
+        ignore_inputs: torch.Tensor = None,
+    ) -> AttributionSpans:
+        """The top_k input spans of every output span (see get_many), as [outputs, top_k] columns"""
+        spans = self.get_many(
+            input_starts=input_starts,
+            input_ends=input_ends,
+            output_starts=output_starts,
+            output_ends=output_ends,
+            ignore_inputs=ignore_inputs,
         )
-        sorted_spans = sorted(
-            enumerate(attribution_spans),
-            key=lambda item: item[1].attribution,
-            reverse=True,
+        top = spans.attributions.topk(min(top_k, spans.shape[-1]), dim=-1).indices
+        return AttributionSpans(
+            output_starts=spans.output_starts.gather(-1, top),
+            output_ends=spans.output_ends.gather(-1, top),
+            input_starts=spans.input_starts.gather(-1, top),
+            input_ends=spans.input_ends.gather(-1, top),
+            attributions=spans.attributions.gather(-1, top),
         )
 
+    def sort(
+        self,
+        output_span: Span,
+        candidate_documents: list[str],
+        candidate_spans: list[Span] | None = None,
+    ):
+        """
+        Rank candidate documents by their attribution. If the Spans of their tokens are known
+        they are used instead of searching for the documents.
+        """
+        if candidate_spans is None:
+            if self._token_index is None:
+                self._token_index = TokenIndex(self.tokens)
+            candidate_spans = find_spans(
+                self.tokenizer, self._token_index, candidate_documents
+            )
+        if not candidate_spans:
+            return []
+
+        attributions = self.get_many(
+            input_starts=torch.tensor([span.start for span in candidate_spans], dtype=torch.long),
+            input_ends=torch.tensor([span.end for span in candidate_spans], dtype=torch.long),
+            output_starts=torch.tensor([self._output_start(output_span)], dtype=torch.long),
+            output_ends=torch.tensor([self._output_end(output_span)], dtype=torch.long),
+        ).attributions[0]
+
         result: list[tuple[int, float]] = []
-        for i, span in sorted_spans:
-            result.append((i, span.attribution))
+        for i in attributions.argsort(descending=True, stable=True).tolist():
+            result.append((i, float(attributions[i])))
         return result
@@ -27,3 +27,58 @@ class AttributionSpan:
 
     def pretty_print(self, tokenizer, tokens) -> str:
         return f"'{self.output_text(tokenizer, tokens)}' attributed to '{self.input_text(tokenizer, tokens)}' with strength {self.attribution}"
+
+
+@dataclass(frozen=True)
+class AttributionSpans:
+    """
+    Many AttributionSpans stored as columns. Span i covers outputs
+    [output_starts[i], output_ends[i]) and inputs [input_starts[i], input_ends[i]). All columns
+    have the same shape, e.g. [outputs, inputs] or [outputs, top_k].
+    """
+
+    output_starts: torch.Tensor = field(kw_only=True)
+    output_ends: torch.Tensor = field(kw_only=True)
+    input_starts: torch.Tensor = field(kw_only=True)
+    input_ends: torch.Tensor = field(kw_only=True)
+    attributions: torch.Tensor = field(kw_only=True)
+
+    @property
+    def shape(self):
+        return self.attributions.shape
+
+    def __len__(self):
+        return len(self.attributions)
+
+    def __getitem__(self, index) -> "AttributionSpan | AttributionSpans":
+        spans = AttributionSpans(
+            output_starts=self.output_starts[index],
+            output_ends=self.output_ends[index],
+            input_starts=self.input_starts[index],
+            input_ends=self.input_ends[index],
+            attributions=self.attributions[index],
+        )
+        if spans.attributions.dim() > 0:
+            return spans
+
+        # A single span, only now are its index lists built
+        return AttributionSpan(
+            output_indices=list(range(int(spans.output_starts), int(spans.output_ends))),
+            input_indices=list(range(int(spans.input_starts), int(spans.input_ends))),
+            attribution=float(spans.attributions),
+        )
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def sorted(self, descending: bool = True) -> "AttributionSpans":
+        """Spans sorted by attribution along the last axis"""
+        order = self.attributions.argsort(dim=-1, descending=descending)
+        return AttributionSpans(
+            output_starts=self.output_starts.gather(-1, order),
+            output_ends=self.output_ends.gather(-1, order),
+            input_starts=self.input_starts.gather(-1, order),
+            input_ends=self.input_ends.gather(-1, order),
+            attributions=self.attributions.gather(-1, order),
+        )
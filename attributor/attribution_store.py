@@ -0,0 +1,180 @@
+import json
+import os
+from dataclasses import dataclass
+from os import PathLike
+
+import numpy as np
+import torch
+
+from attributor.attribution import Attribution
+from attributor.span import Span
+
+INDEX_DTYPE = np.dtype(
+    [("key", "<i8"), ("offset", "<i8"), ("tokens", "<i4"), ("rows", "<i4")]
+)
+DTYPES = {"float32": np.float32, "float16": np.float16, "uint8": np.uint8}
+# Entries start at multiples of this so that every part of them can be viewed in place
+ALIGNMENT = 8
+
+
+def _aligned(size: int) -> int:
+    return -(-size // ALIGNMENT) * ALIGNMENT
+
+
+@dataclass(frozen=True)
+class StoredRows:
+    """
+    Loads the rows of one entry of an AttributionStore when called. Pickles as just where the
+    rows are.
+    """
+
+    blob_filepath: str
+    offset: int
+    tokens: int
+    rows: int
+    dtype: str
+
+    def __call__(self) -> torch.Tensor:
+        if self.rows == 0:
+            return torch.zeros(0, self.tokens, dtype=torch.float32)
+
+        values = np.memmap(
+            self.blob_filepath,
+            dtype=DTYPES[self.dtype],
+            mode="r",
+            offset=self.offset + _aligned(4 * (self.tokens + 2 * self.rows)),
+            shape=(self.rows, self.tokens),
+        )
+        attributions = torch.from_numpy(values.astype(np.float32))
+        if self.dtype == "uint8":
+            scales = np.memmap(
+                self.blob_filepath,
+                dtype=np.float32,
+                mode="r",
+                offset=self.offset + 4 * (self.tokens + self.rows),
+                shape=(self.rows,),
+            )
+            attributions *= torch.from_numpy(np.array(scales)).unsqueeze(-1)
+        return attributions
+
+
+class AttributionStore:
+    """
+    The output rows of many Attributions in one append-only blob file, with an index of where
+    each of them starts. Opening the store only reads the index, the blob is memory-mapped and
+    an Attribution from get only reads its rows once they are used.
+
+    An entry is its int32 tokens, its int32 output indices, a float32 scale per row and the
+    rows, stored as float32, float16 or uint8. uint8 rows are quantized relative to their
+    largest value, which is stored as the scale.
+
+    Stored Attributions have no model, and a tokenizer only if one is passed to get.
+    """
+
+    def __init__(self, dirpath: PathLike, mode: str = "r", dtype: str = "float16"):
+        assert mode in ("r", "a")
+        self.dirpath = dirpath
+        self.mode = mode
+        self._blob_filepath = os.path.join(dirpath, "attributions.bin")
+        self._index_filepath = os.path.join(dirpath, "index.bin")
+        metadata_filepath = os.path.join(dirpath, "metadata.json")
+
+        if os.path.exists(metadata_filepath):
+            with open(metadata_filepath) as fd:
+                self.dtype = json.load(fd)["dtype"]
+        else:
+            assert mode == "a", f"There is no attribution store at {dirpath}"
+            assert dtype in DTYPES, f"dtype must be one of {list(DTYPES)}"
+            os.makedirs(dirpath, exist_ok=True)
+            self.dtype = dtype
+            with open(metadata_filepath, "w") as fd:
+                json.dump({"dtype": dtype}, fd)
+            open(self._blob_filepath, "wb").close()
+            open(self._index_filepath, "wb").close()
+
+        # A crash can leave a partly written last record, which is ignored
+        count = os.path.getsize(self._index_filepath) // INDEX_DTYPE.itemsize
+        index = np.fromfile(self._index_filepath, dtype=INDEX_DTYPE, count=count)
+        # Later entries of the same key replace earlier ones
+        self._entries = {
+            key: (offset, n, rows) for key, offset, n, rows in index.tolist()
+        }
+        self._blob = None
+
+        if mode == "a":
+            with open(self._index_filepath, "rb+") as fd:
+                fd.truncate(count * INDEX_DTYPE.itemsize)
+            self._blob_fd = open(self._blob_filepath, "ab")
+            self._index_fd = open(self._index_filepath, "ab")
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: int) -> bool:
+        return key in self._entries
+
+    def keys(self) -> list[int]:
+        return sorted(self._entries)
+
+    def put(self, key: int, attribution: Attribution, output_span: Span | None = None):
+        """Store the rows of attribution for the outputs in output_span, all rows if None"""
+        assert self.mode == "a", "The store was opened for reading"
+
+        rows = attribution._output_rows(output_span or Span())
+        values = attribution.attributions[rows].detach().to("cpu", torch.float32).numpy()
+        if attribution.output_indices is None:
+            output_indices = np.arange(attribution.attributions.shape[0])[rows]
+        else:
+            output_indices = attribution.output_indices[rows].numpy()
+        tokens = attribution.tokens.reshape(-1).cpu().numpy().astype(np.int32)
+
+        if self.dtype == "uint8":
+            scales = values.max(axis=-1, initial=0).astype(np.float32)
+            values = values / np.maximum(scales, np.finfo(np.float32).tiny)[:, None]
+            values = np.round(values * 255)
+            scales /= 255
+        else:
+            scales = np.ones(len(values), dtype=np.float32)
+        values = values.astype(DTYPES[self.dtype])
+
+        header = tokens.tobytes() + output_indices.astype(np.int32).tobytes() + scales.tobytes()
+        entry = header + bytes(_aligned(len(header)) - len(header)) + values.tobytes()
+        entry += bytes(_aligned(len(entry)) - len(entry))
+
+        offset = self._blob_fd.seek(0, os.SEEK_END)
+        self._blob_fd.write(entry)
+        # The entry is written before it is indexed, so a crash never indexes a partial entry
+        self._blob_fd.flush()
+
+        record = np.array([(key, offset, len(tokens), len(values))], dtype=INDEX_DTYPE)
+        self._index_fd.write(record.tobytes())
+        self._index_fd.flush()
+        self._entries[key] = (offset, len(tokens), len(values))
+        # The blob is mapped again with the new entry the next time it is read
+        self._blob = None
+
+    def get(self, key: int, tokenizer=None) -> Attribution:
+        # Missing keys raise KeyError before an empty blob is mapped, which would fail instead
+        offset, n, rows = self._entries[key]
+        if self._blob is None:
+            self._blob = np.memmap(self._blob_filepath, dtype=np.uint8, mode="r")
+
+        tokens = self._blob[offset : offset + 4 * n].view(np.int32)
+        output_indices = self._blob[offset + 4 * n : offset + 4 * (n + rows)].view(np.int32)
+
+        return Attribution(
+            None,
+            tokenizer,
+            torch.from_numpy(tokens.astype(np.int64)),
+            StoredRows(self._blob_filepath, offset, n, rows, self.dtype),
+            output_indices=torch.from_numpy(output_indices.astype(np.int64)),
+        )
+
+    def __getitem__(self, key: int) -> Attribution:
+        return self.get(key)
+
+    def close(self):
+        if self.mode == "a":
+            self._blob_fd.close()
+            self._index_fd.close()
+        self._blob = None
@@ -1,54 +1,439 @@
+import sys
+from contextlib import contextmanager
+from os import PathLike
+
 import torch
-from transformers import LlamaForCausalLM
 
+from attributor.attention_cache import AttentionCache
+from attributor.architectures import (
+    DEFAULT_CACHE_DIRPATH,
+    attention_weights_index,
+    get_architecture,
+    get_attention_head_weights,
+)
 from attributor.attribution import Attribution
+from attributor.propagation import FusedFlow
+from attributor.sparse import SparseAttention
+from attributor.span import Span
+from attributor.strategies import AttributionStrategy, roll_outputs
+from attributor.triangular import PackedTriangular, tril_matmul
 
 
 class Attributor:
-    def __init__(self, model, tokenizer):
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        streaming: bool = False,
+        padding_side: str = "right",
+        recompute_attention: bool = False,
+        block_size: int = 256,
+        cache_dirpath: PathLike | None = DEFAULT_CACHE_DIRPATH,
+        propagation: str = "dense",
+        sparse_top_k: int | None = None,
+        sparse_top_p: float | None = None,
+        compiled: bool = False,
+        bucket_size: int = 128,
+        attention_cache: AttentionCache | None = None,
+    ):
+        assert padding_side in ("left", "right")
+        assert propagation in ("dense", "triangular", "packed")
         self.model = model
         self.tokenizer = tokenizer
+        # Fold each layer's attention into the flow as soon as it is computed instead of
+        # keeping every layer's [1, heads, len, len] attention alive until the end
+        self.streaming = streaming
+        # Side batches of sequences with different lengths are padded on
+        self.padding_side = padding_side
+        # Let the model run its fast attention kernel (sdpa, flash attention) and recompute the
+        # attention probabilities from the queries and keys captured by hooks, block_size query
+        # rows at a time. This always streams.
+        self.recompute_attention = recompute_attention
+        self.block_size = block_size
+        if recompute_attention and not get_architecture(model).recompute_attention:
+            raise NotImplementedError(
+                f"Recomputing attention of {type(model).__name__} is not supported"
+            )
+        # Attention head weights are cached here, None to always compute them
+        self.cache_dirpath = cache_dirpath
+        # The flow is lower-triangular, "triangular" skips the blocks above the diagonal when
+        # propagating it and "packed" also doesn't store them, block_size rows at a time
+        self.propagation = propagation
+        # Keep only the top k entries or top p mass of every row of every layer's head-reduced
+        # attention and propagate it as a sparse matrix, see attribute_sparse
+        self.sparse_top_k = sparse_top_k
+        self.sparse_top_p = sparse_top_p
+        # Propagate the full flow of single sequences with a compiled kernel in buffers that
+        # are reused by every layer and padded to a multiple of bucket_size (see FusedFlow)
+        self.compiled = compiled
+        self.bucket_size = bucket_size
+        # Read the attention of single sequences from here instead of running the model when
+        # it was captured before, see AttentionCache
+        self.attention_cache = attention_cache
         self._attention_head_weights = None
 
     def _get_attention_head_weights(self):
         if self._attention_head_weights is None:
-            if isinstance(self.model, LlamaForCausalLM):
-                output_projections = [layer.self_attn.o_proj.weight for layer in self.model.model.layers]
-                per_head_output_projections = [o_proj.reshape(self.model.config.num_attention_heads, -1, o_proj.shape[-1]) for o_proj in output_projections]
-                attention_head_weights = [torch.linalg.matrix_norm(o_proj.type(torch.float32), dim=[1,2]).unsqueeze(-1).unsqueeze(-1) for o_proj in per_head_output_projections]
-                self._attention_head_weights = [a / a.sum() for a in attention_head_weights]
-                
-            else:
-                raise NotImplementedError(type(self.model).__name__)
-        
+            self._attention_head_weights = get_attention_head_weights(
+                self.model, self.cache_dirpath
+            )
+
         return self._attention_head_weights
-        
 
-    def attend(self, tokens: torch.Tensor):
-        assert len(tokens.shape) == 1, "Only tokens tensors with rank 1 are supported"
+    def _get_attention_modules(self):
+        return get_architecture(self.model).attention_modules(self.model)
+
+    def _model_inputs(self, tokens: torch.Tensor, attention_mask: torch.Tensor | None = None):
+        if attention_mask is None:
+            assert len(tokens.shape) == 1, "Only tokens tensors with rank 1 are supported"
+            return tokens.unsqueeze(0), {}
+
+        assert len(tokens.shape) == 2, "Batches of tokens must have rank 2"
+        assert tokens.shape == attention_mask.shape
+        # Left padding must not shift the positions of the tokens after it
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp_min(0)
+        return tokens, dict(attention_mask=attention_mask, position_ids=position_ids)
+
+    def attend(self, tokens: torch.Tensor, callback=None, attention_mask: torch.Tensor | None = None):
+        """
+        Run the model over tokens and return the attentions of every layer.
+
+        tokens is either a single [len] sequence or, with attention_mask, a padded [batch, len]
+        batch of sequences.
+
+        If callback is given it is called as callback(layer_index, attention) from a forward
+        hook as each layer's attention is computed, and the attention is dropped from the
+        model outputs so that at most one layer's attention is alive at any time.
+        """
+        if (
+            self.attention_cache is not None
+            and self.attention_cache.per_head
+            and attention_mask is None
+        ):
+            attentions = self._cached_attentions(tokens)
+            if callback is None:
+                return attentions
+            for i, attention in enumerate(attentions):
+                callback(i, attention)
+            return
+
+        tokens, model_kwargs = self._model_inputs(tokens, attention_mask)
 
         with torch.no_grad():
-            tokens = tokens.unsqueeze(0)
-            outputs = self.model(tokens, output_attentions=True)
-            return outputs.attentions
+            if callback is None:
+                outputs = self.model(tokens, output_attentions=True, **model_kwargs)
+                return outputs.attentions
 
-    # @torch.compile(fullgraph=True, dynamic=False)
-    def forward(self, inputs: torch.Tensor, attention: torch.Tensor, attention_head_weights: torch.Tensor):
+            def make_hook(layer_index):
+                def hook(module, args, output):
+                    i = attention_weights_index(output)
+                    callback(layer_index, output[i])
+                    return (*output[:i], None, *output[i + 1 :])
+
+                return hook
+
+            handles = [
+                module.register_forward_hook(make_hook(i))
+                for i, module in enumerate(self._get_attention_modules())
+            ]
+            try:
+                self.model(tokens, output_attentions=True, **model_kwargs)
+            finally:
+                for handle in handles:
+                    handle.remove()
+
+    def attend_reduced(
+        self,
+        tokens: torch.Tensor,
+        callback,
+        attention_mask: torch.Tensor | None = None,
+        attention_head_weights: list[torch.Tensor] | None = None,
+    ):
         """
-        Simple multi-head self attention with residual connection
+        Run the model over tokens and call callback(layer_index, A) with the head-reduced
+        [len, len] (or [batch, len, len]) attention A of each layer as soon as it is computed.
+
+        attention_head_weights overrides the head weights of every layer. Stacking several
+        [heads, 1, 1] weights into [weights, heads, 1, 1] reduces the heads with each of them
+        at once and A gets a leading weights dimension.
+        """
+        if self.attention_cache is not None and attention_mask is None:
+            if self.attention_cache.per_head:
+                attention_head_weights = (
+                    attention_head_weights or self._get_attention_head_weights()
+                )
+                for i, attention in enumerate(self._cached_attentions(tokens)):
+                    callback(i, self._reduce_heads(attention, attention_head_weights[i]))
+                return
+
+            # Only the model's own head weights are cached
+            if attention_head_weights is None:
+                cached = self.attention_cache.get(tokens, self.model.device)
+                if cached is None:
+                    cached = []
+
+                    def keep(layer_index, A):
+                        cached.append(A)
+                        callback(layer_index, A)
+
+                    self._attend_reduced(tokens, keep)
+                    self.attention_cache.put(tokens, cached)
+                else:
+                    for i, A in enumerate(cached):
+                        callback(i, A)
+                return
+
+        self._attend_reduced(tokens, callback, attention_mask, attention_head_weights)
+
+    def _attend_reduced(
+        self,
+        tokens: torch.Tensor,
+        callback,
+        attention_mask: torch.Tensor | None = None,
+        attention_head_weights: list[torch.Tensor] | None = None,
+    ):
+        tokens, model_kwargs = self._model_inputs(tokens, attention_mask)
+        if not self.recompute_attention:
+            model_kwargs["output_attentions"] = True
+
+        with torch.no_grad(), self._reduced_attention_hooks(
+            callback, attention_mask, attention_head_weights
+        ):
+            self.model(tokens, **model_kwargs)
+
+    def _cached_attentions(self, tokens: torch.Tensor):
+        """The per-head attentions of a single sequence, from the model only if not cached"""
+        attentions = self.attention_cache.get(tokens, self.model.device)
+        if attentions is None:
+            tokens, model_kwargs = self._model_inputs(tokens)
+            with torch.no_grad():
+                attentions = self.model(tokens, output_attentions=True, **model_kwargs).attentions
+            self.attention_cache.put(tokens[0], attentions)
+        return attentions
+
+    @contextmanager
+    def _reduced_attention_hooks(
+        self,
+        callback,
+        attention_mask: torch.Tensor | None = None,
+        attention_head_weights: list[torch.Tensor] | None = None,
+    ):
+        """
+        Within this context callback(layer_index, A) is called with the head-reduced attention
+        A of every call of every attention module of the model.
         """
+        attention_head_weights = attention_head_weights or self._get_attention_head_weights()
+
+        def make_hook(layer_index):
+            def hook(module, args, output):
+                i = attention_weights_index(output)
+                callback(
+                    layer_index,
+                    self._reduce_heads(
+                        output[i], attention_head_weights[layer_index], attention_mask
+                    ),
+                )
+                return (*output[:i], None, *output[i + 1 :])
+
+            return hook
+
+        handles = []
+        for i, module in enumerate(self._get_attention_modules()):
+            if self.recompute_attention:
+                handles += self._recompute_hooks(
+                    i, module, callback, attention_head_weights[i], attention_mask
+                )
+            else:
+                handles.append(module.register_forward_hook(make_hook(i)))
+        try:
+            yield
+        finally:
+            for handle in handles:
+                handle.remove()
+
+    def _recompute_hooks(
+        self,
+        layer_index: int,
+        module,
+        callback,
+        attention_head_weights: torch.Tensor,
+        attention_mask: torch.Tensor | None = None,
+    ):
+        """
+        Hooks capturing the queries and keys of an attention module that call
+        callback(layer_index, A) with the recomputed head-reduced attention A. Keys are kept
+        across calls, so this also works when the module attends to a KV cache.
+        """
+        apply_rotary_pos_emb = sys.modules[type(module).__module__].apply_rotary_pos_emb
+        scale = getattr(module, "scaling", None) or module.head_dim**-0.5
+        sliding_window = self._sliding_window(module)
+        captured = {}
+
+        def capture_inputs(module, args, kwargs):
+            captured["kwargs"] = kwargs
+
+        def capture(name):
+            def hook(module, args, output):
+                captured[name] = output
+
+            return hook
+
+        def recompute(module, args, output):
+            query, key = captured.pop("query"), captured.pop("key")
+            batch, queries, _ = query.shape
+            query = query.view(batch, queries, -1, module.head_dim).transpose(1, 2)
+            key = key.view(batch, queries, -1, module.head_dim).transpose(1, 2)
+
+            cos, sin = self._rotary_embeddings(module, key, captured.pop("kwargs"))
+            query, key = apply_rotary_pos_emb(query, key, cos, sin)
+
+            if "keys" in captured:
+                key = torch.cat([captured["keys"], key], dim=-2)
+            captured["keys"] = key
+
+            callback(
+                layer_index,
+                self._recompute_reduced(
+                    query, key, attention_head_weights, scale, attention_mask, sliding_window
+                ),
+            )
+
+        return [
+            module.register_forward_pre_hook(capture_inputs, with_kwargs=True),
+            module.q_proj.register_forward_hook(capture("query")),
+            module.k_proj.register_forward_hook(capture("key")),
+            module.register_forward_hook(recompute),
+        ]
+
+    def _sliding_window(self, module) -> int | None:
+        """How many of the latest keys every query of module attends to, None for all of them"""
+        if hasattr(module, "sliding_window"):
+            return module.sliding_window
+
+        config = module.config
+        if not getattr(config, "use_sliding_window", True):
+            return None
+        layer_types = getattr(config, "layer_types", None)
+        if layer_types is not None and layer_types[module.layer_idx] != "sliding_attention":
+            return None
+        return getattr(config, "sliding_window", None)
+
+    def _rotary_embeddings(self, module, key: torch.Tensor, kwargs: dict):
+        position_embeddings = kwargs.get("position_embeddings")
+        if position_embeddings is not None:
+            return position_embeddings
+        # Older attention modules compute their own rotary embeddings
+        return module.rotary_emb(key, kwargs["position_ids"])
+
+    def _recompute_reduced(
+        self,
+        query: torch.Tensor,
+        key: torch.Tensor,
+        attention_head_weights: torch.Tensor,
+        scale: float,
+        attention_mask: torch.Tensor | None = None,
+        sliding_window: int | None = None,
+    ):
+        """
+        Head-reduced softmax(QK^T) of post-RoPE queries [batch, heads, queries, head_dim] and
+        keys [batch, kv_heads, keys, head_dim], where the queries are the last keys. Rows are
+        computed block_size at a time so at most [batch, heads, block_size, keys] probabilities
+        exist at once. With sliding_window, queries only attend to that many of the latest keys.
+        """
+        batch, heads, queries, _ = query.shape
+        keys = key.shape[-2]
+
+        # Grouped query attention shares every kv head between heads // kv_heads heads
+        key = key.repeat_interleave(heads // key.shape[1], dim=1).type(torch.float32)
+        key = key.transpose(-1, -2)
+
+        positions = torch.arange(keys, device=query.device)
+        padding = None if attention_mask is None else ~attention_mask.type(torch.bool)
 
-        # Remove batch dimension (which must be one), now A is [heads, len, len]
+        # attention_head_weights may stack several weights, see attend_reduced
+        A = torch.empty(
+            *attention_head_weights.shape[:-3],
+            batch,
+            queries,
+            keys,
+            dtype=torch.float32,
+            device=query.device,
+        )
+        for start in range(0, queries, self.block_size):
+            end = min(start + self.block_size, queries)
+            scores = torch.matmul(query[:, :, start:end].type(torch.float32), key)
+            scores *= scale
+
+            # Causal mask, query i is at position keys - queries + i
+            query_positions = positions[keys - queries + start : keys - queries + end, None]
+            masked = positions > query_positions
+            if sliding_window is not None and sliding_window < keys:
+                masked = masked | (positions <= query_positions - sliding_window)
+            if padding is not None:
+                masked = masked | padding[:, None, :]
+            scores = scores.masked_fill(masked.unsqueeze(-3), float("-inf"))
+
+            probabilities = torch.softmax(scores, dim=-1)
+            A[..., start:end, :] = torch.multiply(
+                probabilities, attention_head_weights.unsqueeze(-4)
+            ).sum(axis=-3)
+
+        # Rows of padding are fully masked and nan until they are zeroed here
+        return self._normalize_attention(A.squeeze(-3), attention_mask)
+
+    def _reduce_heads(
+        self,
+        attention: torch.Tensor,
+        attention_head_weights: torch.Tensor,
+        attention_mask: torch.Tensor | None = None,
+    ):
+        # Remove batch dimension if it is one, now A is [heads, len, len] or [batch, heads, len, len]
         A = attention.squeeze(0).type(torch.float32)
 
         # Reduce attention heads to single attention weight matrix according to head weights
         A = torch.multiply(A, attention_head_weights)
-        A = A.sum(axis=0)
-        A /= A.sum(axis=-1, keepdim=True)
-        
-        # attention over inputs, Y is [heads, len, len]
-        Y = torch.matmul(A, inputs)
-        
+        A = A.sum(axis=-3)
+
+        return self._normalize_attention(A, attention_mask)
+
+    def _normalize_attention(self, A: torch.Tensor, attention_mask: torch.Tensor | None = None):
+        if attention_mask is None:
+            A /= A.sum(axis=-1, keepdim=True)
+        else:
+            # Padding neither attends nor is attended to, so rows of padding are all zero.
+            # A may only hold the rows of the last queries.
+            mask = attention_mask.squeeze(0).type(torch.bool)
+            queries = mask[..., mask.shape[-1] - A.shape[-2] :]
+            A = A.masked_fill(~(queries.unsqueeze(-1) & mask.unsqueeze(-2)), 0)
+            A /= A.sum(axis=-1, keepdim=True).clamp_min(torch.finfo(A.dtype).tiny)
+
+        return A
+
+    # @torch.compile(fullgraph=True, dynamic=False)
+    def forward(
+        self,
+        inputs: torch.Tensor,
+        attention: torch.Tensor,
+        attention_head_weights: torch.Tensor,
+        attention_mask: torch.Tensor | None = None,
+    ):
+        """
+        Simple multi-head self attention with residual connection
+        """
+        A = self._reduce_heads(attention, attention_head_weights, attention_mask)
+        return self._propagate(inputs, A)
+
+    def _propagate(self, inputs: torch.Tensor, A: torch.Tensor):
+        if not isinstance(inputs, torch.Tensor):
+            # PackedTriangular or FusedFlow
+            return inputs.propagate(A)
+
+        # attention over inputs, Y is [len, len] (or [batch, len, len])
+        if self.propagation == "triangular":
+            Y = tril_matmul(A, inputs, self.block_size)
+        else:
+            Y = torch.matmul(A, inputs)
+
         # Post-attention residual
         Y += inputs
 
@@ -58,26 +443,534 @@ class Attributor:
 
         return Y
 
-    # @torch.compile
-    def attribute(self, attentions):
-        n = attentions[0].shape[2]
+    def backward(
+        self,
+        outputs: torch.Tensor,
+        attention: torch.Tensor,
+        attention_head_weights: torch.Tensor,
+        attention_mask: torch.Tensor | None = None,
+    ):
+        """
+        Pull output rows of the flow back through one layer.
+
+        The flow after the last layer is the product (A_L + I) ... (A_1 + I) with every row
+        normalized to 1. Every factor is row stochastic up to the factor 2 of the residual, so
+        the rows we care about can be computed right to left as outputs @ (A + I), which is
+        [outputs, len] @ [len, len] instead of [len, len] @ [len, len].
+        """
+        A = self._reduce_heads(attention, attention_head_weights, attention_mask)
+        return self._pull_back(outputs, A)
+
+    def _pull_back(self, outputs: torch.Tensor, A: torch.Tensor):
+        Y = torch.matmul(outputs, A)
+
+        # Residual
+        Y += outputs
+
+        # Normalize rows to 1
+        Y /= Y.sum(axis=-1, keepdim=True)
+
+        return Y
+
+    def _initial_state(self, n: int, device, attention_mask: torch.Tensor | None = None):
+        # The fused kernel only handles single sequences
+        if self.compiled and self.propagation == "dense" and attention_mask is None:
+            return FusedFlow(n, device, self.bucket_size)
+
         # Values will get close to 0, use lots of precision
-        Y = torch.eye(n, n, dtype=torch.float32).to(attentions[0].device)
+        Y = torch.eye(n, n, dtype=torch.float32).to(device)
+        if self.propagation == "packed":
+            return PackedTriangular.from_dense(Y, self.block_size)
+        return Y
+
+    def _dense_state(self, Y):
+        if isinstance(Y, torch.Tensor):
+            return Y
+        return Y.to_dense()
+
+    def _roll_outputs(self, Y: torch.Tensor):
+        return roll_outputs(Y)
+
+    def _flow(self, attentions, attention_mask: torch.Tensor | None = None):
+        n = attentions[0].shape[-1]
+        Y = self._initial_state(n, attentions[0].device, attention_mask)
         for A, o_proj in zip(attentions, self._get_attention_head_weights()):
-            Y = self.forward(Y, A, o_proj)
+            if isinstance(Y, FusedFlow):
+                # Reduce heads into a reused buffer as well
+                Y.fold_heads(A, o_proj)
+            else:
+                Y = self.forward(Y, A, o_proj, attention_mask)
+        return self._dense_state(Y)
+
+    # @torch.compile
+    def attribute(self, attentions):
+        Y = self._flow(attentions)
 
         # Y = torch.stack(attentions, 0).sum(axis=(0,1,2))
         # Y /= Y.sum(axis=-1)
 
-        # We now have Y[i, j] = amount that token j (input) was attended to when generating token i+1 (output), so we need to roll the output axis forward 1
-        Y = torch.roll(Y, 1, 0)
-        # output 0 has no input, it is just given.
-        Y[0, :] = 0
+        return self._roll_outputs(Y)
+
+    def _pull_back_rows(self, reduced_attentions, n: int, flow_rows: torch.Tensor):
+        # reduced_attentions are head-reduced attentions from the last layer to the first
+        Y = torch.nn.functional.one_hot(flow_rows, n).type(torch.float32)
+        for A in reduced_attentions:
+            Y = self._pull_back(Y, A)
+        return Y
+
+    def attribute_rows(self, attentions, output_indices: torch.Tensor):
+        """
+        Compute only the rows of attribute(attentions) given by output_indices by propagating
+        them backward from the last layer.
+        """
+        attention_head_weights = self._get_attention_head_weights()
+        reduced = (
+            self._reduce_heads(A, o_proj)
+            for A, o_proj in zip(reversed(attentions), reversed(attention_head_weights))
+        )
+        output_indices = output_indices.to(attentions[0].device)
+
+        # Output i is attributed by flow row i - 1 (see _roll_outputs)
+        Y = self._pull_back_rows(
+            reduced, attentions[0].shape[-1], (output_indices - 1).clamp_min(0)
+        )
+        # output 0 has no input
+        Y[output_indices == 0] = 0
         return Y
-    
-    def __call__(self, tokens):
+
+    def _stream(
+        self,
+        tokens: torch.Tensor,
+        flow_rows: torch.Tensor | None = None,
+        attention_mask: torch.Tensor | None = None,
+    ):
+        """
+        Fold every layer's attention into the flow from forward hooks and return the flow (not
+        rolled), or, if flow_rows is given, just those rows of it pulled back from the last layer.
+        """
+        n = tokens.shape[-1]
+
+        if flow_rows is not None:
+            # Pulling rows back needs every layer, keep only their head-reduced attention
+            reduced = []
+
+            def keep(layer_index, A):
+                reduced.append(A)
+
+            self.attend_reduced(tokens, keep, attention_mask)
+
+            return self._pull_back_rows(
+                reversed(reduced), n, flow_rows.to(reduced[0].device)
+            )
+
+        flow = {}
+
+        def fold(layer_index, A):
+            Y = flow.get("Y")
+            if Y is None:
+                Y = self._initial_state(n, A.device, attention_mask)
+            flow["Y"] = self._propagate(Y, A)
+
+        self.attend_reduced(tokens, fold, attention_mask)
+
+        return self._dense_state(flow["Y"])
+
+    def attribute_streaming(self, tokens: torch.Tensor, output_indices: torch.Tensor | None = None):
+        """
+        Same as attribute(attend(tokens)) but each layer's attention is folded into the flow
+        from a forward hook and freed, so peak memory is one layer's attention plus the flow.
+
+        If output_indices is given, rows are propagated backward, which needs every layer. In
+        that case only the head-reduced [len, len] attention of each layer is kept.
+        """
+        if output_indices is None:
+            return self._roll_outputs(self._stream(tokens))
+
+        Y = self._stream(tokens, (output_indices - 1).clamp_min(0))
+        Y[(output_indices == 0).to(Y.device)] = 0
+        return Y
+
+    @property
+    def _streams(self):
+        # Cached head-reduced attentions are only read layer by layer
+        return (
+            self.streaming
+            or self.recompute_attention
+            or (self.attention_cache is not None and not self.attention_cache.per_head)
+        )
+
+    @property
+    def sparse(self):
+        return self.sparse_top_k is not None or self.sparse_top_p is not None
+
+    def attribute_sparse(self, tokens: torch.Tensor, output_indices: torch.Tensor | None = None):
+        """
+        Same as attribute_streaming but each layer's head-reduced attention is made sparse (see
+        SparseAttention) as soon as it is computed, so only the kept entries of every layer are
+        ever stored and propagating costs O(kept entries * len) per layer.
+
+        Returns the attributions and an upper bound on the L1 error of each of their rows
+        caused by the dropped attention.
+        """
+        n = tokens.shape[-1]
+        layers = []
+        flow = {}
+
+        def fold(layer_index, A):
+            A = SparseAttention.from_dense(A, self.sparse_top_k, self.sparse_top_p, self.block_size)
+            bound = flow.get("bound")
+            if bound is None:
+                bound = torch.zeros(n, dtype=torch.float32, device=A.dropped.device)
+            flow["bound"] = A.propagate_bound(bound)
+
+            if output_indices is None:
+                Y = flow.get("Y")
+                if Y is None:
+                    Y = torch.eye(n, n, dtype=torch.float32, device=A.dropped.device)
+                flow["Y"] = A.propagate(Y)
+            else:
+                layers.append(A)
+
+        self.attend_reduced(tokens, fold)
+
+        # Output i is attributed by flow row i - 1 and output 0 has no input. Rows are
+        # distributions, so they are never more than 2 apart.
+        error_bounds = self._roll_outputs(flow["bound"].clamp_max(2).unsqueeze(-1)).squeeze(-1)
+        if output_indices is None:
+            return self._roll_outputs(flow["Y"]), error_bounds
+
+        output_indices = output_indices.to(error_bounds.device)
+        Y = torch.nn.functional.one_hot((output_indices - 1).clamp_min(0), n).type(torch.float32)
+        for A in reversed(layers):
+            Y = A.pull_back(Y)
+        Y[output_indices == 0] = 0
+        return Y, error_bounds[output_indices]
+
+    def _group_indicators(self, n: int, groups: list[Span], device):
+        # One column per group, one for tokens in no group and one holding the row sums of the
+        # full [len, len] flow (which starts as ones) used to normalize exactly as forward would
+        Y = torch.zeros(n, len(groups) + 2, dtype=torch.float32, device=device)
+        for i, group in enumerate(groups):
+            Y[slice(group.start, group.end), i] = 1
+        Y[:, -2] = Y[:, :-2].sum(axis=-1) == 0
+        Y[:, -1] = 1
+        return Y
+
+    def forward_grouped(self, inputs: torch.Tensor, attention: torch.Tensor, attention_head_weights: torch.Tensor):
+        """
+        forward for a flow whose input axis has been summed into groups. The flow is linear in
+        its initial state up to the row normalization, so the normalization is taken from the
+        last column, which carries the row sums of the full flow.
+        """
+        A = self._reduce_heads(attention, attention_head_weights)
+        return self._propagate_grouped(inputs, A)
+
+    def _propagate_grouped(self, inputs: torch.Tensor, A: torch.Tensor):
+        Y = torch.matmul(A, inputs)
+        Y += inputs
+        Y /= Y[:, -1:].clone()
+
+        return Y
+
+    def attribute_grouped(self, tokens: torch.Tensor, groups: list[Span]):
+        """
+        Attribute every output token to groups of input tokens (e.g. documents) without ever
+        building the [len, len] flow. The flow starts as a [len, groups] token-to-group indicator
+        instead of the identity.
+
+        Returns a [len, len(groups) + 1] tensor where entry [i, j] equals the sum of
+        attribute(attend(tokens))[i] over the tokens of groups[j], and the last column is the
+        attribution to tokens in no group.
+        """
+        with torch.no_grad():
+            tokens = tokens.squeeze(0).to(self.model.device)
+            n = tokens.shape[0]
+            flow = {}
+
+            def fold(layer_index, A):
+                Y = flow.get("Y")
+                if Y is None:
+                    Y = self._group_indicators(n, groups, A.device)
+                flow["Y"] = self._propagate_grouped(Y, A)
+
+            if self._streams:
+                self.attend_reduced(tokens, fold)
+            else:
+                attention_head_weights = self._get_attention_head_weights()
+                for i, attention in enumerate(self.attend(tokens)):
+                    fold(i, self._reduce_heads(attention, attention_head_weights[i]))
+
+            # Drop the row sums column
+            return self._roll_outputs(flow["Y"][:, :-1])
+
+    def attribute_strategies(
+        self, tokens: torch.Tensor, strategies: list[AttributionStrategy]
+    ) -> dict[str, Attribution]:
+        """
+        Attribute tokens with several strategies from one forward pass of the model. Each
+        layer's attention is reduced once per head weighting the strategies need and folded
+        into every strategy's state.
+
+        Returns an Attribution per strategy name.
+        """
+        if self.attention_cache is not None and not self.attention_cache.per_head:
+            raise NotImplementedError(
+                "Strategies reduce heads with their own weights, which needs an AttentionCache "
+                "with per_head"
+            )
+
         with torch.no_grad():
             tokens = tokens.squeeze(0).to(self.model.device)
-            attentions = self.attend(tokens)
-            attributions = self.attribute(attentions)
-            return Attribution(self.model, self.tokenizer, tokens, attributions)
+            n = tokens.shape[0]
+
+            attention_head_weights = self._get_attention_head_weights()
+            # Stack the head weights of every layer as [2, heads, 1, 1], see attend_reduced
+            stacked_head_weights = [
+                torch.stack([a, torch.full_like(a, 1 / a.shape[0])]) for a in attention_head_weights
+            ]
+            states = [None] * len(strategies)
+
+            def fold(layer_index, A):
+                for i, strategy in enumerate(strategies):
+                    state = states[i]
+                    if state is None:
+                        state = strategy.initial_state(n, A.device)
+                    states[i] = strategy.fold(state, A[int(strategy.uniform_heads)])
+
+            if self._streams:
+                self.attend_reduced(tokens, fold, attention_head_weights=stacked_head_weights)
+            else:
+                for i, attention in enumerate(self.attend(tokens)):
+                    fold(i, self._reduce_heads(attention, stacked_head_weights[i]))
+
+            return {
+                strategy.name: Attribution(
+                    self.model, self.tokenizer, tokens, strategy.finalize(state)
+                )
+                for strategy, state in zip(strategies, states)
+            }
+
+    def generate(self, prompt_tokens: torch.Tensor, generation_config=None, **generate_kwargs):
+        """
+        Generate from prompt_tokens and attribute the generated tokens while they are generated.
+
+        Forward hooks fold the prompt's attention into a flow per layer once, then extend every
+        layer's flow by the rows of each new token, whose attention is computed against the KV
+        cache. The attribution is ready when generation ends, without a second forward pass.
+
+        Returns the generated tokens ([1, len], including the prompt) and their Attribution.
+        """
+        prompt_tokens = prompt_tokens.reshape(1, -1).to(self.model.device)
+        if generation_config is not None:
+            assert generation_config.num_beams in (None, 1), "Beam search is not supported"
+            assert generation_config.num_return_sequences in (None, 1)
+
+        # The flow after each layer. Rows only depend on earlier tokens, so rows of tokens
+        # that were already processed never change and every step only fills in new rows.
+        flows = [None] * len(self._get_attention_modules())
+        capacity = prompt_tokens.shape[1]
+        if generation_config is not None and generation_config.max_new_tokens is not None:
+            capacity += generation_config.max_new_tokens
+
+        def fold(layer_index, A):
+            # A is [queries, keys]
+            queries, keys = A.shape[-2:]
+            new_rows = slice(keys - queries, keys)
+
+            Y = flows[layer_index]
+            if Y is None or Y.shape[0] < keys:
+                size = max(keys, capacity if Y is None else 2 * Y.shape[0])
+                grown = torch.zeros(size, size, dtype=torch.float32, device=A.device)
+                if Y is not None:
+                    grown[: Y.shape[0], : Y.shape[1]] = Y
+                Y = flows[layer_index] = grown
+
+            if layer_index == 0:
+                # The input is the identity
+                Y_new = A.clone()
+                Y_new[torch.arange(queries), torch.arange(keys - queries, keys)] += 1
+            else:
+                inputs = flows[layer_index - 1][:keys, :keys]
+                Y_new = torch.matmul(A, inputs)
+                Y_new += inputs[new_rows]
+
+            Y_new /= Y_new.sum(axis=-1, keepdim=True)
+            Y[new_rows, :keys] = Y_new
+
+        if not self.recompute_attention:
+            generate_kwargs["output_attentions"] = True
+
+        with torch.no_grad(), self._reduced_attention_hooks(fold):
+            generated_tokens = self.model.generate(
+                prompt_tokens,
+                generation_config=generation_config,
+                tokenizer=self.tokenizer,
+                attention_mask=torch.ones_like(prompt_tokens),
+                **generate_kwargs,
+            )
+
+        # The last generated token is never fed back into the model, so the flow covers all but
+        # the last token. Rolled as in _roll_outputs, that is every output.
+        n = generated_tokens.shape[1]
+        Y = flows[-1]
+        attributions = torch.zeros(n, n, dtype=torch.float32, device=Y.device)
+        attributions[1:, :-1] = Y[: n - 1, : n - 1]
+
+        return generated_tokens, Attribution(
+            self.model, self.tokenizer, generated_tokens[0], attributions
+        )
+
+    def _output_indices(self, output_span: Span, n: int):
+        return torch.arange(output_span.start or 0, output_span.end or n)
+
+    def _pad(self, sequences: list[torch.Tensor]):
+        lengths = [sequence.shape[0] for sequence in sequences]
+        n = max(lengths)
+        pad_token_id = getattr(self.tokenizer, "pad_token_id", None) or 0
+
+        tokens = torch.full(
+            (len(sequences), n),
+            pad_token_id,
+            dtype=sequences[0].dtype,
+            device=sequences[0].device,
+        )
+        attention_mask = torch.zeros_like(tokens)
+        offsets = []
+        for i, (sequence, length) in enumerate(zip(sequences, lengths)):
+            offset = n - length if self.padding_side == "left" else 0
+            tokens[i, offset : offset + length] = sequence
+            attention_mask[i, offset : offset + length] = 1
+            offsets.append(offset)
+
+        return tokens, attention_mask, offsets
+
+    def attribute_batch(
+        self,
+        sequences: list[torch.Tensor],
+        output_spans: Span | list[Span | None] | None = None,
+    ) -> list[Attribution]:
+        """
+        Attribute a batch of sequences of different lengths with one padded forward pass.
+
+        output_spans is either one Span (or None) for all sequences or one per sequence, with
+        the same meaning as in __call__.
+        """
+        if self.sparse:
+            raise NotImplementedError("Sparse attribution of batches is not supported")
+
+        with torch.no_grad():
+            sequences = [sequence.squeeze(0).to(self.model.device) for sequence in sequences]
+            tokens, attention_mask, offsets = self._pad(sequences)
+            n = tokens.shape[1]
+            streaming = self.streaming or self.recompute_attention
+
+            if not isinstance(output_spans, (list, tuple)):
+                output_spans = [output_spans] * len(sequences)
+            assert len(output_spans) == len(sequences)
+
+            if all(output_span is None for output_span in output_spans):
+                if streaming:
+                    Y = self._stream(tokens, attention_mask=attention_mask)
+                else:
+                    attentions = self.attend(tokens, attention_mask=attention_mask)
+                    Y = self._flow(attentions, attention_mask)
+                    del attentions
+
+                attributions = []
+                for i, (sequence, offset) in enumerate(zip(sequences, offsets)):
+                    real = slice(offset, offset + sequence.shape[0])
+                    attributions.append(
+                        Attribution(
+                            self.model,
+                            self.tokenizer,
+                            sequence,
+                            self._roll_outputs(Y[i, real, real]),
+                        )
+                    )
+                return attributions
+
+            output_indices = [
+                self._output_indices(output_span or Span(), sequence.shape[0])
+                for output_span, sequence in zip(output_spans, sequences)
+            ]
+
+            # Pull every sequence's rows back at once. Sequences with fewer rows are padded with
+            # rows that are dropped afterwards.
+            flow_rows = torch.zeros(
+                len(sequences), max(len(indices) for indices in output_indices), dtype=torch.long
+            )
+            for i, (indices, offset) in enumerate(zip(output_indices, offsets)):
+                flow_rows[i] = offset
+                # Output i is attributed by flow row i - 1 (see _roll_outputs)
+                flow_rows[i, : len(indices)] += (indices - 1).clamp_min(0)
+
+            if streaming:
+                Y = self._stream(tokens, flow_rows, attention_mask)
+            else:
+                attentions = self.attend(tokens, attention_mask=attention_mask)
+                reduced = (
+                    self._reduce_heads(A, o_proj, attention_mask)
+                    for A, o_proj in zip(
+                        reversed(attentions), reversed(self._get_attention_head_weights())
+                    )
+                )
+                Y = self._pull_back_rows(reduced, n, flow_rows.to(attentions[0].device))
+                del attentions
+
+            attributions = []
+            for i, (sequence, indices, offset) in enumerate(
+                zip(sequences, output_indices, offsets)
+            ):
+                rows = Y[i, : len(indices), offset : offset + sequence.shape[0]].clone()
+                # output 0 has no input
+                rows[(indices == 0).to(rows.device)] = 0
+                attributions.append(
+                    Attribution(
+                        self.model,
+                        self.tokenizer,
+                        sequence,
+                        rows,
+                        output_indices=indices,
+                    )
+                )
+            return attributions
+
+    def __call__(self, tokens, output_span: Span | list[Span | None] | None = None):
+        """
+        Attribute every output token to the input tokens.
+
+        If output_span is given only the rows for outputs in [output_span.start, output_span.end)
+        are computed, and the returned Attribution holds just those rows.
+
+        If tokens is a list of sequences they are attributed as a batch (see attribute_batch)
+        and a list of Attributions is returned.
+        """
+        if isinstance(tokens, (list, tuple)):
+            return self.attribute_batch(tokens, output_span)
+
+        with torch.no_grad():
+            tokens = tokens.squeeze(0).to(self.model.device)
+
+            output_indices = None
+            if output_span is not None:
+                output_indices = self._output_indices(output_span, tokens.shape[0])
+
+            error_bounds = None
+            if self.sparse:
+                attributions, error_bounds = self.attribute_sparse(tokens, output_indices)
+            elif self._streams:
+                attributions = self.attribute_streaming(tokens, output_indices)
+            else:
+                attentions = self.attend(tokens)
+                if output_indices is None:
+                    attributions = self.attribute(attentions)
+                else:
+                    attributions = self.attribute_rows(attentions, output_indices)
+            return Attribution(
+                self.model,
+                self.tokenizer,
+                tokens,
+                attributions,
+                output_indices=output_indices,
+                error_bounds=error_bounds,
+            )
@@ -1,2 +1,7 @@
-from attributor.evaluation.evaluation_case import EvaluationCase, EvaluationResult
-from attributor.evaluation.evaluator import Evaluator, EvaluationProgress
\ No newline at end of file
+from attributor.evaluation.evaluation_case import (
+    DocumentRanking,
+    EvaluationCase,
+    EvaluationResult,
+    FormattedCase,
+)
+from attributor.evaluation.evaluator import Evaluator, EvaluationProgress
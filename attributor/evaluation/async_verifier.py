@@ -0,0 +1,169 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import Future
+
+from openai import AsyncOpenAI
+
+from attributor import get_logger
+from attributor.evaluation.openai_verifier import (
+    parse_verification,
+    reminder_messages,
+    verification_messages,
+)
+
+logger = get_logger()
+
+
+class TokenBucket:
+    """
+    Holds up to capacity tokens and is refilled at rate tokens per second. Waiters are served in
+    the order they arrived.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, amount: float = 1):
+        if self._lock is None:
+            # Created on first use so it belongs to the running loop
+            self._lock = asyncio.Lock()
+
+        # More than capacity would never fit, take everything instead
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= amount
+
+    def debit(self, amount: float):
+        """Take amount without waiting, which can leave the bucket in debt"""
+        self._refill()
+        self.tokens -= amount
+
+
+class AsyncVerifier:
+    """
+    A verifier whose submit returns a Future right away. Calling it blocks until its
+    verification is done.
+    """
+
+    def submit(self, target_answer: str, generated_answer: str) -> Future:
+        raise NotImplementedError
+
+    def __call__(self, target_answer: str, generated_answer: str) -> bool | None:
+        return self.submit(target_answer, generated_answer).result()
+
+    def close(self):
+        pass
+
+
+class AsyncOpenAIVerifier(AsyncVerifier):
+    """
+    openai_verifier run on an event loop in a background thread, with up to max_concurrency
+    requests in flight sharing one limit of max_rpm requests and max_tpm tokens per minute.
+    Either limit may burst up to burst_seconds of its rate at once.
+
+    Tokens are estimated at 4 characters each before a request, and the difference to the usage
+    reported in the response is taken afterwards. base_url can point the verifier at any server
+    with a chat completions endpoint.
+    """
+
+    def __init__(
+        self,
+        openai_client: str | AsyncOpenAI | None = None,
+        *,
+        model="gpt-4o-mini",
+        max_rpm: int | None = 500,
+        max_tpm: int | None = 200_000,
+        max_concurrency: int = 32,
+        burst_seconds: float = 1.0,
+        base_url: str | None = None,
+        max_completion_tokens: int = 16,
+    ):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+        if openai_client is None or isinstance(openai_client, str):
+            openai_client = AsyncOpenAI(api_key=openai_client, base_url=base_url)
+        else:
+            assert isinstance(openai_client, AsyncOpenAI)
+
+        self.openai_client = openai_client
+        self.model = model
+        self.max_completion_tokens = max_completion_tokens
+        self._requests = (
+            TokenBucket(max_rpm / 60, max(1, max_rpm / 60 * burst_seconds))
+            if max_rpm is not None
+            else None
+        )
+        self._tokens = (
+            TokenBucket(max_tpm / 60, max(1, max_tpm / 60 * burst_seconds))
+            if max_tpm is not None
+            else None
+        )
+        self._max_concurrency = max_concurrency
+        self._semaphore = None
+
+    async def _complete(self, messages: list[dict]) -> str:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_concurrency)
+
+        estimated_tokens = (
+            sum(len(message["content"]) for message in messages) // 4
+            + self.max_completion_tokens
+        )
+
+        async with self._semaphore:
+            if self._requests is not None:
+                await self._requests.acquire()
+            if self._tokens is not None:
+                await self._tokens.acquire(estimated_tokens)
+
+            completion = await self.openai_client.chat.completions.create(
+                messages=messages,
+                model=self.model,
+                temperature=0,
+                seed=13,
+                max_tokens=self.max_completion_tokens,
+            )
+
+        if self._tokens is not None and completion.usage is not None:
+            self._tokens.debit(completion.usage.total_tokens - estimated_tokens)
+
+        return completion.choices[0].message.content
+
+    def submit(self, target_answer: str, generated_answer: str) -> Future:
+        return asyncio.run_coroutine_threadsafe(
+            self.verify(target_answer, generated_answer), self._loop
+        )
+
+    async def verify(self, target_answer: str, generated_answer: str) -> bool | None:
+        messages = verification_messages(target_answer, generated_answer)
+
+        for i in range(3):
+            verification = await self._complete(messages)
+            parsed = parse_verification(verification)
+            if parsed is not None:
+                return parsed
+
+            messages += reminder_messages(verification.lower())
+
+        return None
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.openai_client.close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
@@ -7,9 +7,22 @@ class EvaluationCase(BaseModel):
     supporting_documents: list[int]
 
 
+class FormattedCase(BaseModel):
+    context: str
+    # Character range [start, end) of every document in context
+    document_character_spans: list[tuple[int, int]]
+
+
+class DocumentRanking(BaseModel):
+    attributed_documents: list[int]
+    attributed_document_scores: list[float]
+
+
 class EvaluationResult(BaseModel):
     case: SerializeAsAny[EvaluationCase]
     generated_output: str
     attributed_documents: list[int]
     attributed_document_scores: list[float]
-    verification: bool | None = None
\ No newline at end of file
+    verification: bool | None = None
+    # Rankings of every attribution strategy by name, when several were evaluated at once
+    strategies: dict[str, DocumentRanking] = {}
@@ -1,8 +1,17 @@
 import json
+import operator
 import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from itertools import islice
 from os import PathLike
-from typing import Callable, Sequence
+from typing import Callable, Iterator, Sequence
 
+import numpy as np
 import torch
 from pydantic import BaseModel
 from tqdm import tqdm
@@ -10,11 +19,25 @@ from tqdm.contrib.logging import logging_redirect_tqdm
 from transformers import GenerationConfig
 
 from attributor import get_logger
+from attributor.attribution import Attribution
+from attributor.attribution_store import AttributionStore
 from attributor.attributor import Attributor
-from attributor.evaluation.evaluation_case import EvaluationCase, EvaluationResult
+from attributor.evaluation.async_verifier import AsyncVerifier
+from attributor.evaluation.evaluation_case import (
+    DocumentRanking,
+    EvaluationCase,
+    EvaluationResult,
+    FormattedCase,
+)
 from attributor.evaluation.metrics import incremental_mean, precision, recall
+from attributor.evaluation.pipeline import InlineExecutor
+from attributor.evaluation.result_log import ResultLog, atomic_write_json
+from attributor.evaluation.scheduler import schedule_batches
+from attributor.evaluation.sources import StreamingCases
+from attributor.evaluation.tokenized_cases import TokenizedCase, TokenizedCases, case_digest
 from attributor.span import Span
-from attributor.utils import find, tokenize
+from attributor.strategies import AttributionStrategy
+from attributor.utils import find_spans, tokenize, tokenize_with_spans
 
 logger = get_logger()
 
@@ -24,6 +47,88 @@ class EvaluationProgress(BaseModel):
     support: int
     mean_precision: dict[int, float] = {}
     mean_recall: dict[int, float] = {}
+    strategy_mean_precision: dict[str, dict[int, float]] = {}
+    strategy_mean_recall: dict[str, dict[int, float]] = {}
+    # Bytes of the result log this progress covers, later records are replayed on resume
+    log_size: int = 0
+    # Iteration counts the cases of this shard, the log holds their indices in all cases
+    num_shards: int = 1
+    shard_index: int = 0
+
+
+def update_metrics(result: EvaluationResult, progress: EvaluationProgress, verbose: bool = True):
+    """Add a result to the running means of progress, whose support must already count it"""
+    _update_mean_metrics(
+        result, progress.mean_precision, progress.mean_recall, progress.support, verbose
+    )
+
+    for name, ranking in result.strategies.items():
+        if verbose:
+            logger.info(f"Strategy {name}:")
+        _update_mean_metrics(
+            result.model_copy(update=ranking.model_dump()),
+            progress.strategy_mean_precision.setdefault(name, {}),
+            progress.strategy_mean_recall.setdefault(name, {}),
+            progress.support,
+            verbose,
+        )
+
+
+def _update_mean_metrics(
+    result: EvaluationResult,
+    mean_precision: dict[int, float],
+    mean_recall: dict[int, float],
+    support: int,
+    verbose: bool = True,
+):
+    for k in [1, 3, 5, 10]:
+        result_recall = recall(result, k = k)
+        result_precision = precision(result, k = k)
+
+        mean_recall[k] = (
+            result_recall
+            if k not in mean_recall
+            else incremental_mean(
+                mean_recall[k],
+                result_recall,
+                support,
+            )
+        )
+        mean_precision[k] = (
+            result_precision
+            if k not in mean_precision
+            else incremental_mean(
+                mean_precision[k],
+                result_precision,
+                support,
+            )
+        )
+
+        if verbose:
+            logger.info(f"Mean Recall @ {k}: {mean_recall[k]:.1%}")
+            logger.info(f"Mean Precision @ {k}: {mean_precision[k]:.1%}")
+
+
+@dataclass
+class PreparedCase:
+    case: EvaluationCase
+    prompt_tokens: torch.Tensor
+    # None until generated
+    generated_tokens: torch.Tensor | None = None
+    document_spans: list[Span] | None = None
+
+    @property
+    def output_span(self) -> Span:
+        total_token_count = self.generated_tokens.shape[1]
+        prompt_token_count = self.prompt_tokens.shape[1]
+        output_token_count = total_token_count - prompt_token_count
+
+        return Span(
+            start=prompt_token_count,
+            end=total_token_count - 1,
+            step=1,
+            window_size=output_token_count - 1,
+        )
 
 
 class Evaluator:
@@ -32,42 +137,142 @@ class Evaluator:
         *,
         attributor: Attributor,
         progress_dirpath: PathLike,
-        formatter: Callable[[EvaluationCase], str],
-        verifier: Callable[[str, str], bool] | None = None,
+        formatter: Callable[[EvaluationCase], str | FormattedCase],
+        verifier: Callable[[str, str], bool] | AsyncVerifier | None = None,
+        grouped_attribution: bool = False,
+        strategies: list[AttributionStrategy] | None = None,
+        attribution_store: AttributionStore | None = None,
     ):
         assert isinstance(attributor, Attributor)
         assert isinstance(progress_dirpath, (str, os.PathLike))
+        assert not (grouped_attribution and strategies), "Grouped attribution has no strategies"
 
         self.attributor = attributor
         self.verifier = verifier
         self.formatter = formatter
+        # Rank documents from a [len, documents] flow instead of the full [len, len] attribution
+        self.grouped_attribution = grouped_attribution
+        # Rank documents with every strategy from one forward pass, the first is the primary
+        self.strategies = strategies or []
+        # Keep the output rows of every case's attribution, by case index
+        self.attribution_store = attribution_store
         self.progress_dirpath = progress_dirpath
         os.makedirs(self.progress_dirpath, exist_ok=True)
+        # Fast tokenizers can't be used from several threads at once
+        self._tokenizer_lock = threading.Lock()
+        # Verifications of an AsyncVerifier that are still to be logged, counted under the
+        # condition since they are logged from the verifier's thread
+        self._pending_verifications = 0
+        self._verifications_logged = threading.Condition()
 
     @property
     def progress_filepath(self):
         return os.path.join(self.progress_dirpath, "progress.json")
 
-    def save_progress(
-        self,
-        iterator_start: int,
-        progress: EvaluationProgress,
-        evaluation_results: list[EvaluationResult],
-    ):
-        if progress.iteration > iterator_start:
-            logger.info("Saving progress.")
-            with open(self.progress_filepath, "w+") as fd:
-                json.dump(
-                    progress.model_dump(mode="json"),
-                    fd,
-                )
+    @property
+    def results_filepath(self):
+        return os.path.join(self.progress_dirpath, "results.jsonl")
+
+    def save_progress(self, progress: EvaluationProgress, log: ResultLog):
+        """Checkpoint progress up to the end of log, atomically"""
+        log.sync()
+        progress.log_size = log.size()
+        atomic_write_json(self.progress_filepath, progress.model_dump(mode="json"))
+
+    def load_progress(self) -> EvaluationProgress:
+        """The last checkpoint with the results logged after it replayed"""
+        if os.path.exists(self.progress_filepath):
+            with open(self.progress_filepath) as fd:
+                progress = EvaluationProgress(**json.load(fd))
+        else:
+            progress = EvaluationProgress(iteration=0, support=0)
 
-            incremental_results_filepath = os.path.join(
-                self.progress_dirpath, f"{iterator_start}-{progress.iteration}.json"
-            )
+        replayed = 0
+        for record in ResultLog.records(self.results_filepath, progress.log_size):
+            if "result" not in record:
+                continue
+
+            if record["result"] is not None:
+                progress.support += 1
+                update_metrics(EvaluationResult(**record["result"]), progress, verbose=False)
+            progress.iteration += 1
+            replayed += 1
 
-            with open(incremental_results_filepath, "w+") as fd:
-                json.dump([e.model_dump(mode="json") for e in evaluation_results], fd)
+        if replayed:
+            logger.info(f"Replayed {replayed} cases logged after the last checkpoint.")
+        return progress
+
+    def _prepare_case(
+        self,
+        *,
+        case: EvaluationCase,
+        generate: bool = False,
+        max_context_tokens: int | None = 1000,
+        tokenized: TokenizedCase | None = None,
+    ) -> "PreparedCase | None":
+        """
+        Tokenize a case, or return None if its prompt is too long. The tokens of tokenized are
+        used instead if they were tokenized from the same case.
+        """
+        formatted = self.formatter(case)
+        context = formatted.context if isinstance(formatted, FormattedCase) else formatted
+        messages = [{"role": "user", "content": context}]
+
+        if tokenized is not None:
+            document_character_spans = getattr(formatted, "document_character_spans", None)
+            if tokenized.digest == case_digest(
+                context, case.expected_output, document_character_spans
+            ):
+                if (
+                    max_context_tokens is not None
+                    and tokenized.prompt_tokens.shape[1] >= max_context_tokens
+                ):
+                    return None
+                return PreparedCase(
+                    case=case,
+                    prompt_tokens=tokenized.prompt_tokens,
+                    generated_tokens=None if generate else tokenized.full_tokens,
+                    document_spans=(
+                        tokenized.document_spans if isinstance(formatted, FormattedCase) else None
+                    ),
+                )
+            logger.warning("Tokenized case is out of date, tokenizing it again.")
+
+        # Documents whose character spans are known are never searched for in the tokens, but
+        # that needs the offsets of a fast tokenizer
+        document_spans = None
+        with self._tokenizer_lock:
+            if isinstance(formatted, FormattedCase) and getattr(
+                self.attributor.tokenizer, "is_fast", False
+            ):
+                prompt_tokens, document_spans = tokenize_with_spans(
+                    self.attributor.tokenizer,
+                    messages,
+                    formatted.document_character_spans,
+                    add_generation_prompt=True,
+                )
+            else:
+                prompt_tokens = tokenize(
+                    self.attributor.tokenizer, messages, add_generation_prompt=True
+                )
+            if max_context_tokens is not None and prompt_tokens.shape[1] >= max_context_tokens:
+                return None
+
+            generated_tokens = None
+            if not generate:
+                messages.append({
+                    "role": "assistant",
+                    "content": case.expected_output
+                })
+                
+                generated_tokens = tokenize(self.attributor.tokenizer, messages, add_generation_prompt=False)
+
+        return PreparedCase(
+            case=case,
+            prompt_tokens=prompt_tokens,
+            generated_tokens=generated_tokens,
+            document_spans=document_spans,
+        )
 
     def _evaluate_case(
         self,
@@ -76,61 +281,140 @@ class Evaluator:
         generation_config: GenerationConfig | None = None,
         max_context_tokens: int | None = 1000
     ):
-        context = self.formatter(case)
-        messages = [{"role": "user", "content": context}]
-
-        prompt_tokens = tokenize(self.attributor.tokenizer, messages, add_generation_prompt=True)
-        if prompt_tokens.shape[1] >= max_context_tokens:
+        prepared = self._prepare_case(
+            case=case,
+            generate=generation_config is not None,
+            max_context_tokens=max_context_tokens,
+        )
+        if prepared is None:
             return None
-        
-        if generation_config is None:
-            messages.append({
-                "role": "assistant",
-                "content": case.expected_output
-            })
-            
-            generated_tokens = tokenize(self.attributor.tokenizer, messages, add_generation_prompt=False)
-            generated_tokens.to(self.attributor.model.device)
-        else:
-            prompt_tokens = prompt_tokens.to(self.attributor.model.device)
 
-            generated_tokens = self.attributor.model.generate(
-                prompt_tokens,
+        attribution = None
+        if generation_config is not None:
+            # Attribute while generating instead of running the model again afterwards
+            prepared.generated_tokens, attribution = self.attributor.generate(
+                prepared.prompt_tokens,
                 generation_config=generation_config,
-                tokenizer=self.attributor.tokenizer,
-                attention_mask=torch.ones_like(prompt_tokens),
             )
 
-        attribution = self.attributor(generated_tokens)
-
-        total_token_count = generated_tokens.shape[1]
-        prompt_token_count = prompt_tokens.shape[1]
-        output_token_count = total_token_count - prompt_token_count
-
-
-        output_span = Span(
-            start=prompt_token_count,
-            end=total_token_count - 1,
-            step=1,
-            window_size=output_token_count - 1,
+        result, verification = self._rank_case(
+            prepared, self._attribute_case(prepared, attribution)
         )
-
-        output_text = self.attributor.tokenizer.decode(
-            generated_tokens[0, prompt_token_count:-1]
+        if verification is not None:
+            result.verification = verification.result()
+        return result
+
+    def _attribute_batch(self, prepared_cases: list["PreparedCase"]) -> list:
+        """_attribute_case for every case, with one padded forward pass if the mode allows it"""
+        if (
+            len(prepared_cases) == 1
+            or self.strategies
+            or self.grouped_attribution
+            or self.attributor.sparse
+            # Only the attention of single sequences is cached
+            or self.attributor.attention_cache is not None
+        ):
+            return [self._attribute_case(prepared) for prepared in prepared_cases]
+
+        return self.attributor(
+            [prepared.generated_tokens[0] for prepared in prepared_cases],
+            output_span=[prepared.output_span for prepared in prepared_cases],
         )
 
-        if self.verifier is not None:
+    def _attribute_case(self, prepared: "PreparedCase", attribution=None):
+        """
+        Everything that needs the model: an Attribution, a dict of them by strategy name, or
+        the [len, documents + 1] grouped attribution
+        """
+        generated_tokens = prepared.generated_tokens
+        output_span = prepared.output_span
+
+        if self.strategies:
+            return self.attributor.attribute_strategies(generated_tokens, self.strategies)
+
+        if attribution is not None:
+            return attribution
+
+        if self.grouped_attribution:
+            if prepared.document_spans is None:
+                with self._tokenizer_lock:
+                    prepared.document_spans = find_spans(
+                        self.attributor.tokenizer, generated_tokens[0], prepared.case.documents
+                    )
+            return self.attributor.attribute_grouped(generated_tokens, prepared.document_spans)
+
+        # Only the output rows are ever read, so don't propagate the prompt rows
+        return self.attributor(generated_tokens, output_span=output_span)
+
+    def _store_attribution(self, index: int, prepared: "PreparedCase", attributed):
+        if isinstance(attributed, dict):
+            attributed = attributed[self.strategies[0].name]
+        # Grouped attributions have no rows per input token
+        if not isinstance(attributed, Attribution):
+            return
+        try:
+            self.attribution_store.put(index, attributed, prepared.output_span)
+        except Exception:
+            # The case is still ranked, it just can't be explored later
+            logger.error(
+                f"Caught exception storing the attribution of case {index}.", exc_info=True
+            )
+
+    def _rank_case(
+        self, prepared: "PreparedCase", attributed
+    ) -> tuple[EvaluationResult, Future | None]:
+        """
+        Verify the output and rank the documents of a case from _attribute_case. The
+        verification of an AsyncVerifier is returned as a Future instead of waiting for it.
+        """
+        case = prepared.case
+        document_spans = prepared.document_spans
+        output_span = prepared.output_span
+
+        with self._tokenizer_lock:
+            output_text = self.attributor.tokenizer.decode(
+                prepared.generated_tokens[0, output_span.start : output_span.end]
+            )
+
+        pending_verification = None
+        verification = None
+        if isinstance(self.verifier, AsyncVerifier):
+            pending_verification = self.verifier.submit(case.expected_output, output_text)
+        elif self.verifier is not None:
             verification = self.verifier(
                 case.expected_output,
                 output_text,
             )
-        else:
-            verification = None
 
-        attributed_documents = attribution.sort(
-            output_span,
-            case.documents,
-        )
+        if document_spans is None and not isinstance(attributed, torch.Tensor):
+            # Only searching for the documents needs the tokenizer, ranking doesn't
+            with self._tokenizer_lock:
+                document_spans = find_spans(
+                    self.attributor.tokenizer, prepared.generated_tokens[0], case.documents
+                )
+
+        rankings = {}
+        if isinstance(attributed, dict):
+            for name, strategy_attribution in attributed.items():
+                ranked = strategy_attribution.sort(output_span, case.documents, document_spans)
+                rankings[name] = DocumentRanking(
+                    attributed_documents=[i for i, _ in ranked],
+                    attributed_document_scores=[score for _, score in ranked],
+                )
+            ranking = rankings[self.strategies[0].name]
+            attributed_documents = zip(
+                ranking.attributed_documents, ranking.attributed_document_scores
+            )
+        elif isinstance(attributed, torch.Tensor):
+            # Drop the column of tokens in no document
+            document_scores = attributed[output_span.start : output_span.end, :-1]
+            attributed_documents = sorted(
+                enumerate(document_scores.sum(axis=0).tolist()),
+                key=lambda item: item[1],
+                reverse=True,
+            )
+        else:
+            attributed_documents = attributed.sort(output_span, case.documents, document_spans)
 
         attributed_document_ids = []
         attributed_document_scores = []
@@ -139,94 +423,345 @@ class Evaluator:
             attributed_document_ids.append(i)
             attributed_document_scores.append(score)
 
-        return EvaluationResult(
+        result = EvaluationResult(
             case=case,
             generated_output=output_text,
             attributed_documents=attributed_document_ids,
             attributed_document_scores=attributed_document_scores,
             verification=verification,
+            strategies=rankings,
         )
 
-    def _update_metrics(self, result: EvaluationResult, progress: EvaluationProgress):
-        for k in [1, 3, 5, 10]:
-            result_recall = recall(result, k = k)
-            result_precision = precision(result, k = k)
-
-            mean_recall = progress.mean_recall.get(k, None)
-            mean_precision = progress.mean_precision.get(k, None)
-
-            progress.mean_recall[k] = (
-                result_recall
-                if mean_recall is None
-                else incremental_mean(
-                    mean_recall,
-                    result_recall,
-                    progress.support,
-                )
+        return result, pending_verification
+
+    def _log_result(
+        self, log: ResultLog, index: int, result: EvaluationResult, verification: Future | None
+    ):
+        """
+        Log the result of case index. A verification that is still running is logged on its own
+        once it is done, without waiting for it.
+        """
+        if verification is not None and verification.done():
+            try:
+                result.verification = verification.result()
+            except Exception:
+                logger.error(f"Caught exception verifying case {index}.", exc_info=True)
+            verification = None
+
+        log.append_result(index, result)
+        if verification is None:
+            return
+
+        with self._verifications_logged:
+            self._pending_verifications += 1
+
+        def done(verification: Future):
+            try:
+                log.append({"index": index, "verification": verification.result()})
+            except Exception:
+                logger.error(f"Caught exception verifying case {index}.", exc_info=True)
+            finally:
+                with self._verifications_logged:
+                    self._pending_verifications -= 1
+                    self._verifications_logged.notify_all()
+
+        verification.add_done_callback(done)
+
+    def _wait_for_verifications(self):
+        """Wait until every verification that is still running has been logged"""
+        with self._verifications_logged:
+            if self._pending_verifications:
+                logger.info(f"Waiting for {self._pending_verifications} verifications.")
+            # Futures are done before their callbacks run, so wait for the callbacks instead
+            self._verifications_logged.wait_for(lambda: self._pending_verifications == 0)
+
+    def _shard_cases(
+        self,
+        cases: Sequence[EvaluationCase] | StreamingCases,
+        start: int,
+        num_shards: int = 1,
+        shard_index: int = 0,
+        fits: np.ndarray | None = None,
+    ) -> Iterator[tuple[int, Callable[[], EvaluationCase] | None]]:
+        """
+        The index of every case of a shard from its start-th case on, with a function that
+        loads the case so that it is loaded (and formatted) wherever the case is prepared.
+        Cases that fits says are too long are never loaded, their function is None.
+        """
+        offset = shard_index + start * num_shards
+        if isinstance(cases, StreamingCases):
+            rows = islice(cases.rows_from(offset), 0, None, num_shards)
+            loaders = (
+                (offset + k * num_shards, partial(cases.transform, row))
+                for k, row in enumerate(rows)
             )
-            progress.mean_precision[k] = (
-                result_precision
-                if mean_precision is None
-                else incremental_mean(
-                    mean_precision,
-                    result_precision,
-                    progress.support,
-                )
+        else:
+            loaders = (
+                (i, partial(operator.getitem, cases, i))
+                for i in range(offset, len(cases), num_shards)
             )
 
-            logger.info(f"Mean Recall @ {k}: {progress.mean_recall[k]:.1%}")
-            logger.info(f"Mean Precision @ {k}: {progress.mean_precision[k]:.1%}")
+        for i, load_case in loaders:
+            if fits is not None and i < len(fits) and not fits[i]:
+                load_case = None
+            yield i, load_case
 
+    def _prepare_window(
+        self,
+        window: list[tuple[int, Callable[[], EvaluationCase] | None]],
+        generate: bool = False,
+        max_context_tokens: int | None = 1000,
+        tokenized_cases: TokenizedCases | None = None,
+    ) -> dict[int, "PreparedCase | None"]:
+        """_prepare_case for the cases of window, None for cases that are too long or failed"""
+        prepared = {}
+        for i, load_case in window:
+            if load_case is None:
+                prepared[i] = None
+                continue
+            try:
+                prepared[i] = self._prepare_case(
+                    case=load_case(),
+                    generate=generate,
+                    max_context_tokens=max_context_tokens,
+                    tokenized=(
+                        tokenized_cases[i]
+                        if tokenized_cases is not None and i < len(tokenized_cases)
+                        else None
+                    ),
+                )
+            except Exception:
+                logger.error(
+                    f"Caught exception evaluating case {i}.", exc_info=True, stack_info=True
+                )
+                prepared[i] = None
+        return prepared
+
+    def _attribute_window(
+        self,
+        prepared: dict[int, "PreparedCase | None"],
+        generation_config: GenerationConfig | None = None,
+        max_batch_tokens: int | None = None,
+    ) -> dict:
+        """
+        _attribute_case for the prepared cases of a window, in length-sorted batches of at most
+        max_batch_tokens padded tokens if it is given. Cases that fail are left out.
+        """
+        attributed = {}
+        indices = [i for i, prepared_case in prepared.items() if prepared_case is not None]
+
+        if generation_config is not None:
+            for i in indices:
+                try:
+                    # Attribute while generating instead of running the model again afterwards
+                    prepared[i].generated_tokens, attribution = self.attributor.generate(
+                        prepared[i].prompt_tokens,
+                        generation_config=generation_config,
+                    )
+                    attributed[i] = self._attribute_case(prepared[i], attribution)
+                except Exception:
+                    logger.error(
+                        f"Caught exception evaluating case {i}.", exc_info=True, stack_info=True
+                    )
+            return attributed
+
+        if max_batch_tokens is None:
+            batches = [[j] for j in range(len(indices))]
+        else:
+            lengths = [prepared[i].generated_tokens.shape[1] for i in indices]
+            batches = schedule_batches(lengths, max_batch_tokens)
+
+        for batch in batches:
+            batch = [indices[j] for j in batch]
+            try:
+                attributed.update(zip(batch, self._attribute_batch([prepared[i] for i in batch])))
+                continue
+            except Exception:
+                if len(batch) > 1:
+                    logger.warning(
+                        f"Caught exception evaluating cases {batch} as a batch, evaluating them "
+                        "one at a time.",
+                        exc_info=True,
+                    )
+                else:
+                    logger.error(
+                        f"Caught exception evaluating case {batch[0]}.",
+                        exc_info=True,
+                        stack_info=True,
+                    )
+                    continue
+
+            for i in batch:
+                try:
+                    attributed[i] = self._attribute_case(prepared[i])
+                except Exception:
+                    logger.error(
+                        f"Caught exception evaluating case {i}.", exc_info=True, stack_info=True
+                    )
+
+        return attributed
 
     def evaluate(
         self,
         *,
-        cases: Sequence[EvaluationCase],
+        cases: Sequence[EvaluationCase] | StreamingCases,
         generation_config: GenerationConfig | None = None,
+        max_context_tokens: int | None = 1000,
+        tokenized_cases: TokenizedCases | None = None,
+        max_batch_tokens: int | None = None,
+        schedule_window: int = 64,
+        prefetch: int = 0,
+        prepare_workers: int = 1,
+        postprocess_depth: int = 0,
+        postprocess_workers: int = 1,
+        checkpoint_every: int = 100,
+        checkpoint_seconds: float = 300,
+        num_shards: int = 1,
+        shard_index: int = 0,
     ):
+        """
+        Evaluate cases, resuming from the progress saved in progress_dirpath. cases are either
+        a sequence or StreamingCases, which are only read as far as they are evaluated.
+
+        With max_batch_tokens, each window of schedule_window cases is tokenized up front and
+        attributed in batches of similar lengths holding at most max_batch_tokens padded tokens.
+        Generation is always case by case.
+
+        The main thread only runs the model. With prefetch, prepare_workers threads format and
+        tokenize up to prefetch cases ahead of it, and with postprocess_depth,
+        postprocess_workers threads verify and rank up to postprocess_depth cases behind it.
+
+        Results are appended to results.jsonl as soon as they are written back, and progress is
+        checkpointed every checkpoint_every cases or checkpoint_seconds seconds, whichever comes
+        first. Results are never kept in memory.
+
+        With num_shards, only every num_shards-th case starting at shard_index is evaluated, so
+        that shards get cases of all lengths. Every shard needs its own progress_dirpath, see
+        sharding.shard_dirpath, and their results can be combined with sharding.merge_shards.
+
+        Cases whose prompts have max_context_tokens or more tokens are skipped. With
+        tokenized_cases, from tokenized_cases.tokenize_cases, cases are not tokenized again and
+        the ones that are too long are skipped without being loaded.
+        """
+        assert 0 <= shard_index < num_shards
         os.makedirs(self.progress_dirpath, exist_ok=True)
 
-        progress_filepath = os.path.join(self.progress_dirpath, "progress.json")
-
-        if os.path.exists(progress_filepath):
-            with open(progress_filepath) as fd:
-                progress = json.load(fd)
-                progress = EvaluationProgress(**progress)
-        else:
-            progress = EvaluationProgress(iteration=0, support=0)
+        progress = self.load_progress()
+        if progress.iteration == 0:
+            progress.num_shards = num_shards
+            progress.shard_index = shard_index
+        assert (progress.num_shards, progress.shard_index) == (num_shards, shard_index), (
+            f"{self.progress_dirpath} holds shard {progress.shard_index} of "
+            f"{progress.num_shards}, not {shard_index} of {num_shards}"
+        )
+        log = ResultLog(self.results_filepath)
+        # Replayed results are now covered by the checkpoint
+        self.save_progress(progress, log)
 
         logger.info("Beginning evaluation.")
         iterator_start = progress.iteration
-        evaluation_results = []
-        iterator = range(iterator_start, len(cases))
-        try:
-            with logging_redirect_tqdm():
-                for i in tqdm(iterator, initial=iterator_start):
+        checkpoint = (progress.iteration, time.monotonic())
+        # Batches are only formed within windows of consecutive cases, which are read from
+        # cases only as they are needed
+        window_size = 1 if max_batch_tokens is None else schedule_window
+        fits = None
+        if tokenized_cases is not None and max_context_tokens is not None:
+            fits = tokenized_cases.prompt_lengths < max_context_tokens
+        shard_cases = self._shard_cases(cases, iterator_start, num_shards, shard_index, fits)
+        total = operator.length_hint(cases)
+        total = -(-max(0, total - shard_index) // num_shards) if total else None
+
+        prepare_executor = (
+            ThreadPoolExecutor(prepare_workers) if prefetch > 0 else InlineExecutor()
+        )
+        postprocess_executor = (
+            ThreadPoolExecutor(postprocess_workers) if postprocess_depth > 0 else InlineExecutor()
+        )
+        prepared_windows = deque()
+        ranked_windows = deque()
+
+        def prepare_ahead():
+            while len(prepared_windows) * window_size < max(prefetch, 1):
+                window = list(islice(shard_cases, window_size))
+                if not window:
+                    return
+                future = prepare_executor.submit(
+                    self._prepare_window,
+                    window,
+                    generation_config is not None,
+                    max_context_tokens,
+                    tokenized_cases,
+                )
+                prepared_windows.append(([i for i, _ in window], future))
+
+        def write_back(indices, ranked):
+            # Write results back in their original order
+            for i in indices:
+                result = None
+                verification = None
+                if i in ranked:
                     try:
-                        case = cases[i]
-
-                        result = self._evaluate_case(
-                            case=case,
-                            generation_config=generation_config
-                        )
-
-                        if result is not None:
-                            evaluation_results.append(result)
-                            progress.support += 1
-                            self._update_metrics(result, progress)
-
-                    except Exception as ex:
+                        result, verification = ranked[i].result()
+                    except Exception:
                         logger.error(
                             f"Caught exception evaluating case {i}.",
-                            ex,
                             exc_info=True,
                             stack_info=True,
                         )
 
-                    progress.iteration += 1
+                if result is not None:
+                    progress.support += 1
+                    update_metrics(result, progress)
+
+                self._log_result(log, i, result, verification)
+                progress.iteration += 1
+            progress_bar.update(len(indices))
+
+            nonlocal checkpoint
+            if (
+                progress.iteration - checkpoint[0] >= checkpoint_every
+                or time.monotonic() - checkpoint[1] >= checkpoint_seconds
+            ):
+                self.save_progress(progress, log)
+                checkpoint = (progress.iteration, time.monotonic())
+
+        try:
+            with logging_redirect_tqdm(), tqdm(
+                total=total, initial=iterator_start
+            ) as progress_bar:
+                prepare_ahead()
+                while prepared_windows:
+                    indices, prepared = prepared_windows.popleft()
+                    prepared = prepared.result()
+                    prepare_ahead()
+
+                    attributed = self._attribute_window(
+                        prepared, generation_config, max_batch_tokens
+                    )
+                    if self.attribution_store is not None:
+                        for i in attributed:
+                            self._store_attribution(i, prepared[i], attributed[i])
+                    ranked = {
+                        i: postprocess_executor.submit(self._rank_case, prepared[i], attributed[i])
+                        for i in attributed
+                    }
+                    ranked_windows.append((indices, ranked))
                     torch.cuda.empty_cache()
 
+                    while ranked_windows and (
+                        len(ranked_windows) * window_size > postprocess_depth
+                        or all(future.done() for future in ranked_windows[0][1].values())
+                    ):
+                        write_back(*ranked_windows.popleft())
+
+                while ranked_windows:
+                    write_back(*ranked_windows.popleft())
+
         except (Exception, KeyboardInterrupt) as ex:
             raise ex
         finally:
-            self.save_progress(iterator_start, progress, evaluation_results)
+            prepare_executor.shutdown(wait=False, cancel_futures=True)
+            postprocess_executor.shutdown(wait=False, cancel_futures=True)
+            self._wait_for_verifications()
+            self.save_progress(progress, log)
+            log.close()
@@ -1,3 +1,7 @@
+import re
+import string
+from collections import Counter
+
 from attributor.evaluation.evaluation_case import EvaluationResult
 
 
@@ -31,3 +35,23 @@ def mean_recall(results: list[EvaluationResult], k=None):
 
 def incremental_mean(mean, value, n):
     return mean + ((value - mean) / n)
+
+
+def normalize_answer(answer: str) -> str:
+    """Lowercase without punctuation, articles and repeated whitespace, as in SQuAD"""
+    answer = answer.lower()
+    answer = "".join(c for c in answer if c not in string.punctuation)
+    answer = re.sub(r"\b(a|an|the)\b", " ", answer)
+    return " ".join(answer.split())
+
+
+def token_f1(target_answer: str, generated_answer: str) -> float:
+    target_tokens = normalize_answer(target_answer).split()
+    generated_tokens = normalize_answer(generated_answer).split()
+    common = sum((Counter(target_tokens) & Counter(generated_tokens)).values())
+    if common == 0:
+        return 0.0
+
+    precision = common / len(generated_tokens)
+    recall = common / len(target_tokens)
+    return 2 * precision * recall / (precision + recall)
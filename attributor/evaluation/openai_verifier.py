@@ -3,6 +3,41 @@ from time import sleep
 
 from openai import OpenAI
 
+INSTRUCTION = "Is the provided answer correct? Simply answer Yes or No."
+# Bump whenever the messages change, cached verifications of other versions are not reused
+PROMPT_VERSION = 1
+
+
+def verification_messages(target_answer, generated_answer) -> list[dict]:
+    return [
+        {
+            "role": "user",
+            "content": f"Correct Answer: {target_answer}\n\nProvided Answer: {generated_answer}\n\n{INSTRUCTION}",
+        }
+    ]
+
+
+def parse_verification(verification: str) -> bool | None:
+    """True for yes, False for no and None if the verifier didn't say either"""
+    verification = verification.lower()
+
+    if "yes" in verification:
+        return True
+    elif "no" in verification:
+        return False
+    return None
+
+
+def reminder_messages(verification: str) -> list[dict]:
+    return [
+        {"role": "assistant", "content": verification},
+        {
+            "role": "user",
+            "content": "I told to you to ONLY say 'yes' or 'no'! "
+            + INSTRUCTION,
+        },
+    ]
+
 
 def openai_verifier(
     target_answer,
@@ -18,14 +53,7 @@ def openai_verifier(
     else:
         assert isinstance(openai_client, OpenAI)
 
-    instruction = "Is the provided answer correct? Simply answer Yes or No."
-
-    messages = [
-        {
-            "role": "user",
-            "content": f"Correct Answer: {target_answer}\n\nProvided Answer: {generated_answer}\n\n{instruction}",
-        }
-    ]
+    messages = verification_messages(target_answer, generated_answer)
 
     if max_rpm is not None:
         rate_delay = 60 / max_rpm + 1e-2
@@ -40,20 +68,10 @@ def openai_verifier(
         )
 
         verification = completion.choices[0].message.content
-        verification = verification.lower()
-
-        if "yes" in verification:
-            return True
-        elif "no" in verification:
-            return False
-        else:
-            messages += [
-                {"role": "assistant", "content": verification},
-                {
-                    "role": "user",
-                    "content": "I told to you to ONLY say 'yes' or 'no'! "
-                    + instruction,
-                },
-            ]
+        parsed = parse_verification(verification)
+        if parsed is not None:
+            return parsed
+
+        messages += reminder_messages(verification.lower())
 
     return None
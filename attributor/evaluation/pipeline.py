@@ -0,0 +1,13 @@
+from concurrent.futures import Executor, Future
+
+
+class InlineExecutor(Executor):
+    """An Executor that runs every task as soon as it is submitted, on the calling thread"""
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as ex:
+            future.set_exception(ex)
+        return future
@@ -0,0 +1,123 @@
+import json
+import os
+import threading
+from os import PathLike
+from typing import Iterable, Iterator
+
+from attributor import get_logger
+from attributor.evaluation.evaluation_case import EvaluationResult
+from attributor.utils import atomic_write
+
+logger = get_logger()
+
+
+def atomic_write_json(filepath: PathLike, data):
+    """Write data as JSON to filepath so that it holds either the old or the new data"""
+
+    def write(temporary_filepath: str):
+        with open(temporary_filepath, "w") as fd:
+            json.dump(data, fd)
+            fd.flush()
+            os.fsync(fd.fileno())
+
+    atomic_write(filepath, write)
+
+
+class ResultLog:
+    """
+    Append-only JSONL log of evaluated cases. Every case gets a record
+    {"index": i, "result": result or null} in order, and a verification that finishes after its
+    result was logged gets a record {"index": i, "verification": verification}.
+
+    Records are flushed as they are appended, so a killed process loses at most the line being
+    written, which is dropped when the log is opened again.
+    """
+
+    def __init__(self, filepath: PathLike):
+        self.filepath = filepath
+        self._repair()
+        self._fd = open(filepath, "ab")
+        self._lock = threading.Lock()
+
+    def _repair(self):
+        if not os.path.exists(self.filepath):
+            return
+
+        with open(self.filepath, "rb+") as fd:
+            size = fd.seek(0, os.SEEK_END)
+            # Only look back as far as the last newline
+            end = size
+            while end > 0:
+                start = max(0, end - 4096)
+                fd.seek(start)
+                newline = fd.read(end - start).rfind(b"\n")
+                if newline >= 0:
+                    end = start + newline + 1
+                    break
+                end = start
+
+            if end < size:
+                logger.warning(f"Dropping {size - end} bytes of a partly written record.")
+                fd.truncate(end)
+
+    def size(self) -> int:
+        with self._lock:
+            self._fd.flush()
+            return self._fd.tell()
+
+    def append(self, record: dict):
+        line = json.dumps(record).encode() + b"\n"
+        with self._lock:
+            self._fd.write(line)
+            self._fd.flush()
+
+    def append_result(self, index: int, result: EvaluationResult | None):
+        self.append(
+            {
+                "index": index,
+                "result": None if result is None else result.model_dump(mode="json"),
+            }
+        )
+
+    def sync(self):
+        with self._lock:
+            self._fd.flush()
+            os.fsync(self._fd.fileno())
+
+    def close(self):
+        with self._lock:
+            self._fd.close()
+
+    @staticmethod
+    def records(filepath: PathLike, offset: int = 0) -> Iterator[dict]:
+        """The records of the log at filepath, starting at byte offset"""
+        if not os.path.exists(filepath):
+            return
+
+        with open(filepath, "rb") as fd:
+            fd.seek(offset)
+            for line in fd:
+                # A partly written last line
+                if not line.endswith(b"\n"):
+                    return
+                yield json.loads(line)
+
+    @staticmethod
+    def indexed_results(records: Iterable[dict]) -> dict[int, EvaluationResult]:
+        """
+        All logged results by case index in order, with the verifications that finished later
+        filled in
+        """
+        results = {}
+        for record in records:
+            if "result" in record:
+                if record["result"] is not None:
+                    results[record["index"]] = EvaluationResult(**record["result"])
+            elif record["index"] in results:
+                results[record["index"]].verification = record["verification"]
+        return {index: results[index] for index in sorted(results)}
+
+    @staticmethod
+    def results(records: Iterable[dict]) -> list[EvaluationResult]:
+        """All logged results in order, with the verifications that finished later filled in"""
+        return list(ResultLog.indexed_results(records).values())
@@ -0,0 +1,18 @@
+def schedule_batches(lengths: list[int], max_batch_tokens: int) -> list[list[int]]:
+    """
+    Group the indices of lengths into batches of similar lengths, so that every batch padded to
+    its longest sequence holds at most max_batch_tokens tokens. Sequences longer than that get
+    a batch of their own.
+    """
+    batches = []
+    batch = []
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        # Sorted, so lengths[i] is the longest of the batch
+        if batch and (len(batch) + 1) * lengths[i] > max_batch_tokens:
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+
+    if batch:
+        batches.append(batch)
+    return batches
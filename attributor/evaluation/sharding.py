@@ -0,0 +1,115 @@
+import heapq
+import os
+import subprocess
+from os import PathLike
+
+from attributor import get_logger
+from attributor.evaluation.evaluation_case import EvaluationResult
+from attributor.evaluation.evaluator import EvaluationProgress, update_metrics
+from attributor.evaluation.result_log import ResultLog, atomic_write_json
+
+logger = get_logger()
+
+
+def shard_dirpath(progress_dirpath: PathLike, num_shards: int, shard_index: int) -> str:
+    if num_shards == 1:
+        return progress_dirpath
+    return os.path.join(progress_dirpath, f"shard-{shard_index}-of-{num_shards}")
+
+
+def launch_shards(
+    command: list[str], num_shards: int, devices: list[str] | None = None
+) -> list[int]:
+    """
+    Run command once per shard, with --num_shards and --shard_index appended, and return their
+    exit codes. Shards are spread round robin over the CUDA devices, and the CPU threads are
+    split evenly between them.
+    """
+    threads = max(1, (os.cpu_count() or 1) // num_shards)
+    processes = []
+    try:
+        for shard_index in range(num_shards):
+            env = dict(os.environ, OMP_NUM_THREADS=str(threads))
+            if devices:
+                env["CUDA_VISIBLE_DEVICES"] = devices[shard_index % len(devices)]
+
+            logger.info(f"Launching shard {shard_index} of {num_shards}.")
+            processes.append(
+                subprocess.Popen(
+                    [
+                        *command,
+                        "--num_shards",
+                        str(num_shards),
+                        "--shard_index",
+                        str(shard_index),
+                    ],
+                    env=env,
+                )
+            )
+        return [process.wait() for process in processes]
+    except KeyboardInterrupt:
+        # Shards save their progress when interrupted
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        raise
+
+
+def _result_records(filepath: PathLike):
+    for record in ResultLog.records(filepath):
+        if "result" in record:
+            yield record
+
+
+def merge_shards(
+    progress_dirpath: PathLike, num_shards: int
+) -> EvaluationProgress:
+    """
+    Merge the result logs of all shards of progress_dirpath into its own result log, in the
+    order of the cases, and recompute the metrics from them.
+
+    The results are replayed in the same order a single process would have evaluated them in,
+    so the metrics are exactly the ones it would have computed.
+    """
+    shard_dirpaths = [
+        shard_dirpath(progress_dirpath, num_shards, shard_index)
+        for shard_index in range(num_shards)
+    ]
+    for dirpath in shard_dirpaths:
+        with open(os.path.join(dirpath, "progress.json")) as fd:
+            shard_progress = EvaluationProgress.model_validate_json(fd.read())
+        assert shard_progress.num_shards == num_shards, f"{dirpath} is not one of {num_shards}"
+        logger.info(f"{dirpath}: {shard_progress.iteration} cases.")
+
+    results_filepaths = [os.path.join(dirpath, "results.jsonl") for dirpath in shard_dirpaths]
+    merged_filepath = os.path.join(progress_dirpath, "results.jsonl")
+    if os.path.exists(merged_filepath):
+        os.remove(merged_filepath)
+
+    progress = EvaluationProgress(iteration=0, support=0)
+    log = ResultLog(merged_filepath)
+    # Every shard logs its results in order, so they can be merged as they are read
+    for record in heapq.merge(
+        *[_result_records(filepath) for filepath in results_filepaths],
+        key=lambda record: record["index"],
+    ):
+        log.append(record)
+        if record["result"] is not None:
+            progress.support += 1
+            update_metrics(EvaluationResult(**record["result"]), progress, verbose=False)
+        progress.iteration += 1
+
+    # Verifications that finished after their result was logged
+    for filepath in results_filepaths:
+        for record in ResultLog.records(filepath):
+            if "result" not in record:
+                log.append(record)
+
+    log.sync()
+    progress.log_size = log.size()
+    log.close()
+    atomic_write_json(
+        os.path.join(progress_dirpath, "progress.json"), progress.model_dump(mode="json")
+    )
+    return progress
@@ -0,0 +1,70 @@
+import hashlib
+from itertools import islice
+from typing import Callable, Iterable, Iterator
+
+from attributor.evaluation.evaluation_case import EvaluationCase
+
+
+def sampled(index: int, sample: float, seed: int = 0) -> bool:
+    """Whether the row at index is kept when sampling a fraction sample of the rows"""
+    digest = hashlib.blake2b(f"{seed}:{index}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little") / 2**64 < sample
+
+
+class StreamingCases:
+    """
+    Evaluation cases made by transform from a stream of rows, such as a streaming dataset, only
+    as they are needed. rows(offset) returns an iterator over the rows starting at row offset.
+
+    With sample, every row is kept with that probability, decided by a hash of its position and
+    seed so that the same rows are kept every time. limit caps the number of cases. length is
+    the number of rows, if it is known.
+    """
+
+    def __init__(
+        self,
+        rows: Callable[[int], Iterable],
+        transform: Callable[[object], EvaluationCase],
+        limit: int | None = None,
+        sample: float | None = None,
+        seed: int = 0,
+        length: int | None = None,
+    ):
+        self.rows = rows
+        self.transform = transform
+        self.limit = limit
+        self.sample = sample
+        self.seed = seed
+        self.length = length
+
+    def __length_hint__(self) -> int:
+        length = self.length
+        if length is not None and self.sample is not None:
+            length = round(length * self.sample)
+        if self.limit is not None:
+            length = self.limit if length is None else min(length, self.limit)
+        return length or 0
+
+    def rows_from(self, offset: int) -> Iterator:
+        """The rows of the cases from the offset-th case on"""
+        if self.sample is None:
+            # Skipping rows is left to the stream, which may be able to seek
+            stop = None if self.limit is None else max(0, self.limit - offset)
+            yield from islice(self.rows(offset), stop)
+            return
+
+        kept = 0
+        for position, row in enumerate(self.rows(0)):
+            if not sampled(position, self.sample, self.seed):
+                continue
+            if self.limit is not None and kept >= self.limit:
+                return
+            if kept >= offset:
+                yield row
+            kept += 1
+
+    def iter_from(self, offset: int) -> Iterator[EvaluationCase]:
+        return map(self.transform, self.rows_from(offset))
+
+    def __iter__(self) -> Iterator[EvaluationCase]:
+        return self.iter_from(0)
@@ -0,0 +1,210 @@
+import hashlib
+import json
+import os
+from dataclasses import dataclass
+from functools import partial
+from os import PathLike
+from typing import Callable, Sequence
+
+import numpy as np
+import torch
+
+from attributor import get_logger
+from attributor.architectures import DEFAULT_CACHE_DIRPATH
+from attributor.evaluation.evaluation_case import EvaluationCase, FormattedCase
+from attributor.span import Span
+from attributor.utils import atomic_write, offsets_to_spans
+
+logger = get_logger()
+
+ARRAYS = [
+    "prompt_tokens",
+    "prompt_offsets",
+    "full_tokens",
+    "full_offsets",
+    "document_spans",
+    "document_offsets",
+    "has_document_spans",
+    "digests",
+]
+
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    """A filename-safe id of tokenizer from its name, vocabulary and special tokens"""
+    name = getattr(tokenizer, "name_or_path", "") or type(tokenizer).__name__
+    digest = hashlib.sha256(name.encode())
+    if getattr(tokenizer, "is_fast", False):
+        digest.update(tokenizer.backend_tokenizer.to_str().encode())
+    else:
+        digest.update(json.dumps(tokenizer.get_vocab(), sort_keys=True).encode())
+    digest.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True, default=str).encode())
+    return f"{name.strip('/').replace('/', '--')}-{digest.hexdigest()[:16]}"
+
+
+def chat_template_hash(tokenizer) -> str:
+    template = json.dumps(tokenizer.chat_template, sort_keys=True)
+    return hashlib.sha256(template.encode()).hexdigest()[:16]
+
+
+def case_digest(
+    context: str,
+    expected_output: str,
+    document_character_spans: list[tuple[int, int]] | None = None,
+) -> int:
+    """A hash of what a case is tokenized from, to tell whether its cached tokens still apply"""
+    spans = json.dumps([list(span) for span in document_character_spans or []])
+    digest = hashlib.blake2b(
+        f"{context}\0{expected_output}\0{spans}".encode(), digest_size=8
+    )
+    return int.from_bytes(digest.digest(), "little")
+
+
+@dataclass
+class TokenizedCase:
+    prompt_tokens: torch.Tensor
+    # The prompt followed by the expected output
+    full_tokens: torch.Tensor
+    # None if they weren't known when the case was tokenized
+    document_spans: list[Span] | None
+    digest: int
+
+
+class TokenizedCases:
+    """
+    The chat template tokens of a sequence of cases, saved by tokenize_cases: the prompt, the
+    prompt followed by the expected output and the token spans of the documents of every case.
+    The arrays are memory-mapped, so prompt_lengths can filter cases without reading them.
+    """
+
+    def __init__(self, dirpath: PathLike):
+        self.dirpath = dirpath
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(dirpath, f"{name}.npy"), mmap_mode="r"))
+        self.prompt_lengths = np.diff(self.prompt_offsets)
+
+    def __len__(self) -> int:
+        return len(self.digests)
+
+    def __getitem__(self, index: int) -> TokenizedCase:
+        prompt_start, prompt_end = self.prompt_offsets[index : index + 2]
+        full_start, full_end = self.full_offsets[index : index + 2]
+        prompt_tokens = self.prompt_tokens[prompt_start:prompt_end]
+        full_tokens = self.full_tokens[full_start:full_end]
+
+        document_spans = None
+        if self.has_document_spans[index]:
+            spans_start, spans_end = self.document_offsets[index : index + 2]
+            document_spans = [
+                Span(start=start, end=end, step=1, window_size=max(end - start, 1))
+                for start, end in self.document_spans[spans_start:spans_end].tolist()
+            ]
+
+        return TokenizedCase(
+            prompt_tokens=torch.from_numpy(prompt_tokens.astype(np.int64)).unsqueeze(0),
+            full_tokens=torch.from_numpy(full_tokens.astype(np.int64)).unsqueeze(0),
+            document_spans=document_spans,
+            digest=int(self.digests[index]),
+        )
+
+
+def _tokenize_batch(tokenizer, formatter, cases: list[EvaluationCase]) -> list[tuple]:
+    formatted = [formatter(case) for case in cases]
+    contexts = [f.context if isinstance(f, FormattedCase) else f for f in formatted]
+    prompts = [[{"role": "user", "content": context}] for context in contexts]
+    fulls = [
+        [*prompt, {"role": "assistant", "content": case.expected_output}]
+        for prompt, case in zip(prompts, cases)
+    ]
+    prompt_texts = tokenizer.apply_chat_template(
+        prompts, tokenize=False, add_generation_prompt=True
+    )
+    full_texts = tokenizer.apply_chat_template(fulls, tokenize=False, add_generation_prompt=False)
+
+    # Offsets need a fast tokenizer, which also encodes the whole batch in parallel
+    is_fast = getattr(tokenizer, "is_fast", False)
+    prompt_encoding = tokenizer(
+        prompt_texts, add_special_tokens=False, return_offsets_mapping=is_fast
+    )
+    full_encoding = tokenizer(full_texts, add_special_tokens=False)
+
+    tokenized = []
+    for i, case in enumerate(cases):
+        document_spans = None
+        if is_fast and isinstance(formatted[i], FormattedCase):
+            offsets = torch.tensor(prompt_encoding["offset_mapping"][i], dtype=torch.long)
+            spans = offsets_to_spans(
+                offsets.reshape(-1, 2),
+                formatted[i].document_character_spans,
+                prompt_texts[i].rindex(contexts[i]),
+            )
+            document_spans = [(span.start, span.end) for span in spans]
+        tokenized.append(
+            (
+                prompt_encoding["input_ids"][i],
+                full_encoding["input_ids"][i],
+                document_spans,
+                case_digest(
+                    contexts[i],
+                    case.expected_output,
+                    getattr(formatted[i], "document_character_spans", None),
+                ),
+            )
+        )
+    return tokenized
+
+
+def _save(tokenized: list[tuple], dirpath: PathLike):
+    prompts, fulls, spans, digests = zip(*tokenized) if tokenized else ([], [], [], [])
+    arrays = {
+        "prompt_tokens": np.fromiter(
+            (token for prompt in prompts for token in prompt), dtype=np.int32
+        ),
+        "prompt_offsets": np.cumsum([0, *map(len, prompts)], dtype=np.int64),
+        "full_tokens": np.fromiter((token for full in fulls for token in full), dtype=np.int32),
+        "full_offsets": np.cumsum([0, *map(len, fulls)], dtype=np.int64),
+        "document_spans": np.array(
+            [span for case_spans in spans for span in case_spans or []], dtype=np.int32
+        ).reshape(-1, 2),
+        "document_offsets": np.cumsum(
+            [0, *[len(case_spans or []) for case_spans in spans]], dtype=np.int64
+        ),
+        "has_document_spans": np.array([s is not None for s in spans], dtype=bool),
+        "digests": np.array(digests, dtype=np.uint64),
+    }
+
+    os.makedirs(dirpath, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(dirpath, f"{name}.npy"), array)
+
+
+def tokenize_cases(
+    tokenizer,
+    cases: Sequence[EvaluationCase],
+    formatter: Callable[[EvaluationCase], FormattedCase | str],
+    name: str,
+    cache_dirpath: PathLike = DEFAULT_CACHE_DIRPATH,
+    batch_size: int = 256,
+) -> TokenizedCases:
+    """
+    TokenizedCases of cases, tokenized in batches of batch_size and saved in cache_dirpath
+    under the tokenizer, its chat template and name, which must identify cases and formatter.
+    Cases whose tokens are out of date anyway are told apart by their digest.
+    """
+    dirpath = os.path.join(
+        cache_dirpath,
+        "tokenized_cases",
+        tokenizer_fingerprint(tokenizer),
+        chat_template_hash(tokenizer),
+        name,
+    )
+    if os.path.exists(dirpath):
+        return TokenizedCases(dirpath)
+
+    logger.info(f"Tokenizing {len(cases)} cases into {dirpath}.")
+    tokenized = []
+    for start in range(0, len(cases), batch_size):
+        batch = [cases[i] for i in range(start, min(start + batch_size, len(cases)))]
+        tokenized.extend(_tokenize_batch(tokenizer, formatter, batch))
+
+    atomic_write(dirpath, partial(_save, tokenized))
+    return TokenizedCases(dirpath)
@@ -0,0 +1,154 @@
+import os
+import sqlite3
+import threading
+from concurrent.futures import Future
+from os import PathLike
+from typing import Callable
+
+from attributor import get_logger
+from attributor.evaluation.async_verifier import AsyncVerifier
+from attributor.evaluation.metrics import normalize_answer, token_f1
+from attributor.evaluation.openai_verifier import PROMPT_VERSION
+
+logger = get_logger()
+
+YES_NO = {"yes", "no"}
+
+
+def local_verification(
+    target_answer: str, generated_answer: str, f1_threshold: float = 0.8
+) -> bool | None:
+    """
+    Verify the obvious cases without a verifier: the same answers up to normalization, answers
+    with a token F1 of at least f1_threshold, and different yes/no answers. None otherwise.
+    """
+    target = normalize_answer(target_answer)
+    generated = normalize_answer(generated_answer)
+
+    if target == generated:
+        return True
+    if target in YES_NO and generated in YES_NO:
+        return False
+    if token_f1(target, generated) >= f1_threshold:
+        return True
+    return None
+
+
+class CachedVerifier(AsyncVerifier):
+    """
+    Verifications of verifier cached in SQLite at cache_filepath, keyed by the normalized
+    answers, the verifier model and the prompt version. Obvious cases are answered by
+    local_verification, unless f1_threshold is None, and never reach the cache or the verifier.
+    Undecided verifications are not cached.
+
+    verifier may be an AsyncVerifier, in which case misses are submitted to it, or any
+    callable, which is then called right away.
+    """
+
+    def __init__(
+        self,
+        verifier: Callable[[str, str], bool | None] | AsyncVerifier,
+        cache_filepath: PathLike,
+        *,
+        model: str | None = None,
+        prompt_version: int = PROMPT_VERSION,
+        f1_threshold: float | None = 0.8,
+    ):
+        self.verifier = verifier
+        self.model = model if model is not None else getattr(verifier, "model", None)
+        assert self.model is not None, "The verifier has no model, pass one"
+        self.prompt_version = prompt_version
+        self.f1_threshold = f1_threshold
+
+        self.local_hits = 0
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(cache_filepath)), exist_ok=True)
+        # Verifications are stored from the verifier's threads
+        self._connection = sqlite3.connect(cache_filepath, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS verifications ("
+                "target TEXT, generated TEXT, model TEXT, prompt_version INTEGER, "
+                "verification INTEGER, "
+                "PRIMARY KEY (target, generated, model, prompt_version))"
+            )
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {"local_hits": self.local_hits, "hits": self.hits, "misses": self.misses}
+
+    def _count(self, stat: str):
+        with self._lock:
+            setattr(self, stat, getattr(self, stat) + 1)
+
+    def _key(self, target_answer: str, generated_answer: str) -> tuple:
+        return (
+            normalize_answer(target_answer),
+            normalize_answer(generated_answer),
+            self.model,
+            self.prompt_version,
+        )
+
+    def _lookup(self, key: tuple) -> bool | None:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT verification FROM verifications "
+                "WHERE target = ? AND generated = ? AND model = ? AND prompt_version = ?",
+                key,
+            ).fetchone()
+        return None if row is None else bool(row[0])
+
+    def _store(self, key: tuple, verification: Future):
+        if verification.cancelled() or verification.exception() is not None:
+            return
+        if verification.result() is None:
+            return
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO verifications VALUES (?, ?, ?, ?, ?)",
+                (*key, int(verification.result())),
+            )
+
+    def submit(self, target_answer: str, generated_answer: str) -> Future:
+        verification = (
+            local_verification(target_answer, generated_answer, self.f1_threshold)
+            if self.f1_threshold is not None
+            else None
+        )
+        if verification is not None:
+            self._count("local_hits")
+        else:
+            key = self._key(target_answer, generated_answer)
+            verification = self._lookup(key)
+            self._count("hits" if verification is not None else "misses")
+
+        if verification is not None:
+            future = Future()
+            future.set_result(verification)
+            return future
+
+        if isinstance(self.verifier, AsyncVerifier):
+            future = self.verifier.submit(target_answer, generated_answer)
+        else:
+            future = Future()
+            try:
+                future.set_result(self.verifier(target_answer, generated_answer))
+            except Exception as ex:
+                future.set_exception(ex)
+
+        future.add_done_callback(lambda verification: self._store(key, verification))
+        return future
+
+    def close(self):
+        logger.info(
+            f"Verification cache: {self.local_hits} answered locally, {self.hits} hits and "
+            f"{self.misses} misses."
+        )
+        if isinstance(self.verifier, AsyncVerifier):
+            self.verifier.close()
+        with self._lock:
+            self._connection.close()
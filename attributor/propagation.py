@@ -0,0 +1,109 @@
+import torch
+
+from attributor import get_logger
+
+logger = get_logger()
+
+
+def bucket_length(n: int, bucket_size: int = 128) -> int:
+    """n rounded up to a multiple of bucket_size"""
+    return -(-n // bucket_size) * bucket_size
+
+
+def _propagate_in_place(A: torch.Tensor, Y: torch.Tensor, out: torch.Tensor, row_sums: torch.Tensor):
+    """
+    out = (A + I) @ Y with rows normalized to 1, after normalizing the rows of A, without
+    allocating anything
+    """
+    torch.sum(A, -1, keepdim=True, out=row_sums)
+    A.div_(row_sums)
+
+    torch.matmul(A, Y, out=out)
+    # Post-attention residual
+    out.add_(Y)
+
+    torch.sum(out, -1, keepdim=True, out=row_sums)
+    out.div_(row_sums)
+
+
+_compiled_propagate_in_place = None
+
+
+def _compiled_kernel():
+    global _compiled_propagate_in_place
+    if _compiled_propagate_in_place is None:
+        # Buffers are padded to buckets, so there is one graph per bucket
+        _compiled_propagate_in_place = torch.compile(
+            _propagate_in_place, dynamic=False, fullgraph=True
+        )
+    return _compiled_propagate_in_place
+
+
+def _fall_back_to_eager_kernel(ex: Exception):
+    """Run every flow, including later ones, with the eager kernel once compiling failed"""
+    global _compiled_propagate_in_place
+    logger.warning(f"Compiling the propagation kernel failed, running eagerly: {ex}")
+    _compiled_propagate_in_place = _propagate_in_place
+
+
+class FusedFlow:
+    """
+    The [len, len] flow of a single sequence propagated one layer at a time in buffers that are
+    allocated once and reused by every layer.
+
+    Buffers are padded to a multiple of bucket_size so the compiled kernel is built once per
+    bucket instead of once per length. Padding rows attend only to themselves and no real row
+    attends to them, so they never touch the real block. If compiling fails the eager kernel,
+    which does the same in place, is used instead by this and every later flow.
+    """
+
+    def __init__(self, n: int, device, bucket_size: int = 128, compiled: bool = True):
+        self.n = n
+        self.compiled = compiled
+        size = bucket_length(n, bucket_size)
+
+        # Values will get close to 0, use lots of precision
+        self._Y = torch.eye(size, size, dtype=torch.float32, device=device)
+        self._out = torch.empty_like(self._Y)
+        self._A = torch.eye(size, size, dtype=torch.float32, device=device)
+        self._A[:n, :n] = 0
+        self._row_sums = torch.empty(size, 1, dtype=torch.float32, device=device)
+        self._reduced = None
+
+    def to_dense(self) -> torch.Tensor:
+        return self._Y[: self.n, : self.n]
+
+    def propagate(self, A: torch.Tensor):
+        """Propagate the flow through a layer with head-reduced attention A [len, len]"""
+        self._A[: self.n, : self.n].copy_(A)
+        self._propagate()
+        return self
+
+    def fold_heads(self, attention: torch.Tensor, attention_head_weights: torch.Tensor):
+        """
+        Propagate the flow through a layer with per-head attention [1, heads, len, len]. The
+        heads are reduced with one matmul into a reused buffer.
+        """
+        heads = attention_head_weights.shape[0]
+        if self._reduced is None:
+            self._reduced = torch.empty(
+                1, self.n * self.n, dtype=torch.float32, device=self._A.device
+            )
+        torch.matmul(
+            attention_head_weights.reshape(1, heads),
+            attention.reshape(heads, -1).type(torch.float32),
+            out=self._reduced,
+        )
+        self.propagate(self._reduced.view(self.n, self.n))
+
+    def _propagate(self):
+        if self.compiled:
+            try:
+                _compiled_kernel()(self._A, self._Y, self._out, self._row_sums)
+            except Exception as ex:
+                _fall_back_to_eager_kernel(ex)
+                self.compiled = False
+        if not self.compiled:
+            _propagate_in_place(self._A, self._Y, self._out, self._row_sums)
+
+        self._Y, self._out = self._out, self._Y
@@ -0,0 +1,99 @@
+import torch
+
+
+def _keep_mask(A: torch.Tensor, top_k: int | None = None, top_p: float | None = None):
+    keep = A > 0
+    if top_k is not None and top_k < A.shape[-1]:
+        top = torch.zeros_like(keep)
+        keep &= top.scatter_(-1, A.topk(top_k, dim=-1).indices, True)
+    if top_p is not None:
+        values, indices = A.sort(dim=-1, descending=True)
+        # Keep the largest entries until they hold top_p of the row's mass
+        within = (values.cumsum(dim=-1) - values) < top_p * values.sum(dim=-1, keepdim=True)
+        keep &= torch.zeros_like(keep).scatter_(-1, indices, within)
+    return keep
+
+
+class SparseAttention:
+    """
+    A head-reduced [len, len] attention with all but the top_k entries or the top_p mass of
+    every row dropped, stored as a CSR matrix.
+
+    The rows of attention sum to 1, so the kept entries of row i sum to 1 - dropped[i]. One
+    layer of the flow is Y = (A + I) @ Y with rows normalized, and as the rows of Y sum to 1
+    the row sums of (A + I) @ Y are 2 - dropped, whatever Y is. A layer is therefore the fixed
+    row-stochastic scale * (A + I), which also lets rows be pulled back exactly.
+    """
+
+    def __init__(
+        self,
+        rows: torch.Tensor,
+        columns: torch.Tensor,
+        values: torch.Tensor,
+        dropped: torch.Tensor,
+    ):
+        n = dropped.shape[0]
+        self.rows = rows
+        self.columns = columns
+        self.values = values
+        self.dropped = dropped
+        self.scale = 1 / (2 - dropped)
+
+        # Entries must be in row-major order
+        crow_indices = torch.zeros(n + 1, dtype=torch.long, device=rows.device)
+        crow_indices[1:] = torch.bincount(rows, minlength=n).cumsum(0)
+        self.attention = torch.sparse_csr_tensor(
+            crow_indices, columns, values, (n, n), check_invariants=False
+        )
+        self._transposed = None
+
+    @classmethod
+    def from_dense(
+        cls,
+        A: torch.Tensor,
+        top_k: int | None = None,
+        top_p: float | None = None,
+        block_size: int = 256,
+    ):
+        n = A.shape[-1]
+        rows, columns, values = [], [], []
+        dropped = torch.empty(n, dtype=A.dtype, device=A.device)
+        # Sorting rows for top_p copies them, so only do block_size rows at a time
+        for start in range(0, n, block_size):
+            block = A[start : start + block_size]
+            keep = _keep_mask(block, top_k, top_p)
+            dropped[start : start + block.shape[0]] = (
+                block.sum(dim=-1) - (block * keep).sum(dim=-1)
+            ).clamp_min(0)
+
+            # nonzero returns entries in row-major order
+            block_rows, block_columns = keep.nonzero(as_tuple=True)
+            rows.append(block_rows + start)
+            columns.append(block_columns)
+            values.append(block[block_rows, block_columns])
+
+        return cls(torch.cat(rows), torch.cat(columns), torch.cat(values), dropped)
+
+    def propagate(self, Y: torch.Tensor) -> torch.Tensor:
+        """The flow Y [len, ...] after this layer"""
+        scale = self.scale.reshape(-1, *[1] * (Y.dim() - 1))
+        return (torch.sparse.mm(self.attention, Y) + Y) * scale
+
+    def pull_back(self, outputs: torch.Tensor) -> torch.Tensor:
+        """Rows outputs [rows, len] of the flow after this layer pulled back to before it"""
+        if self._transposed is None:
+            n = self.dropped.shape[0]
+            self._transposed = torch.sparse_coo_tensor(
+                torch.stack([self.columns, self.rows]), self.values, (n, n)
+            ).to_sparse_csr()
+
+        outputs = outputs * self.scale
+        return torch.sparse.mm(self._transposed, outputs.T).T + outputs
+
+    def propagate_bound(self, bound: torch.Tensor) -> torch.Tensor:
+        """
+        Given an upper bound on the L1 error of every row of the flow before this layer, return
+        one for after it. The error of row i is a convex combination of the errors of the rows
+        it attends to plus at most dropped[i] for the mass dropped from row i itself.
+        """
+        return self.propagate(bound.unsqueeze(-1)).squeeze(-1) + self.dropped
@@ -0,0 +1,76 @@
+import torch
+
+
+def roll_outputs(Y: torch.Tensor):
+    # We now have Y[i, j] = amount that token j (input) was attended to when generating token i+1 (output), so we need to roll the output axis forward 1
+    Y = torch.roll(Y, 1, -2)
+    # output 0 has no input, it is just given.
+    Y[..., 0, :] = 0
+    return Y
+
+
+class AttributionStrategy:
+    """
+    An attribution method that is folded over the head-reduced [len, len] attention of every
+    layer in order, so several strategies can share one forward pass of the model.
+    """
+
+    name: str = None
+    # Reduce attention heads uniformly instead of by the norms of their output projections
+    uniform_heads: bool = False
+
+    def initial_state(self, n: int, device) -> torch.Tensor:
+        # Values will get close to 0, use lots of precision
+        return torch.eye(n, n, dtype=torch.float32).to(device)
+
+    def fold(self, state: torch.Tensor, A: torch.Tensor) -> torch.Tensor:
+        raise NotImplementedError
+
+    def finalize(self, state: torch.Tensor) -> torch.Tensor:
+        return roll_outputs(state)
+
+
+class RolloutStrategy(AttributionStrategy):
+    """Attention flow with residual connections, the same as Attributor.forward"""
+
+    name = "rollout"
+
+    def fold(self, state: torch.Tensor, A: torch.Tensor) -> torch.Tensor:
+        Y = torch.matmul(A, state)
+        Y += state
+        Y /= Y.sum(axis=-1, keepdim=True)
+        return Y
+
+
+class InformationFlowStrategy(AttributionStrategy):
+    """Attention flow without residual connections"""
+
+    name = "information_flow"
+
+    def fold(self, state: torch.Tensor, A: torch.Tensor) -> torch.Tensor:
+        Y = torch.matmul(A, state)
+        Y /= Y.sum(axis=-1, keepdim=True)
+        return Y
+
+
+class TotalAttentionStrategy(AttributionStrategy):
+    """Attention summed over all heads and layers"""
+
+    name = "total_attention"
+    uniform_heads = True
+
+    def initial_state(self, n: int, device) -> torch.Tensor:
+        return torch.zeros(n, n, dtype=torch.float32, device=device)
+
+    def fold(self, state: torch.Tensor, A: torch.Tensor) -> torch.Tensor:
+        state += A
+        return state
+
+    def finalize(self, state: torch.Tensor) -> torch.Tensor:
+        return roll_outputs(state / state.sum(axis=-1, keepdim=True))
+
+
+STRATEGIES: dict[str, type[AttributionStrategy]] = {
+    strategy.name: strategy
+    for strategy in (RolloutStrategy, InformationFlowStrategy, TotalAttentionStrategy)
+}
@@ -0,0 +1,69 @@
+import torch
+
+
+def _blocks(n: int, block_size: int):
+    return [(start, min(start + block_size, n)) for start in range(0, n, block_size)]
+
+
+def tril_matmul(A: torch.Tensor, B: torch.Tensor, block_size: int = 256) -> torch.Tensor:
+    """
+    A @ B for lower-triangular A [..., n, n] and B [..., n, n].
+
+    Rows start:end of the product only depend on the first end columns of A and the first end
+    rows and columns of B, so the blocks above the diagonal are never multiplied, which takes
+    about a third of the FLOPs of a dense matmul.
+    """
+    n = A.shape[-1]
+    batch_shape = torch.broadcast_shapes(A.shape[:-2], B.shape[:-2])
+    Y = torch.zeros(*batch_shape, n, n, dtype=B.dtype, device=B.device)
+    for start, end in _blocks(n, block_size):
+        Y[..., start:end, :end] = torch.matmul(A[..., start:end, :end], B[..., :end, :end])
+    return Y
+
+
+class PackedTriangular:
+    """
+    A lower-triangular [..., n, n] flow stored as row blocks, where the rows start:end only
+    keep their first end columns. This takes about half the memory of the dense flow.
+    """
+
+    def __init__(self, blocks: list[torch.Tensor], n: int, block_size: int):
+        self.blocks = blocks
+        self.n = n
+        self.block_size = block_size
+
+    @classmethod
+    def from_dense(cls, Y: torch.Tensor, block_size: int = 256):
+        n = Y.shape[-1]
+        blocks = [Y[..., start:end, :end].clone() for start, end in _blocks(n, block_size)]
+        return cls(blocks, n, block_size)
+
+    def to_dense(self) -> torch.Tensor:
+        first = self.blocks[0]
+        Y = torch.zeros(*first.shape[:-2], self.n, self.n, dtype=first.dtype, device=first.device)
+        for (start, end), block in zip(_blocks(self.n, self.block_size), self.blocks):
+            Y[..., start:end, :end] = block
+        return Y
+
+    def propagate(self, A: torch.Tensor):
+        """
+        Y = A @ Y + Y with rows normalized to 1, the same as Attributor._propagate, in place.
+
+        New rows only depend on old rows at or above them, so the blocks are updated from the
+        last to the first.
+        """
+        blocks = _blocks(self.n, self.block_size)
+        for i in reversed(range(len(blocks))):
+            start, end = blocks[i]
+            Y = torch.matmul(A[..., start:end, start:end], self.blocks[i])
+            for k, (k_start, k_end) in enumerate(blocks[:i]):
+                Y[..., :k_end] += torch.matmul(A[..., start:end, k_start:k_end], self.blocks[k])
+
+            # Post-attention residual
+            Y += self.blocks[i]
+
+            # Normalize rows to 1
+            Y /= Y.sum(axis=-1, keepdim=True)
+            self.blocks[i] = Y
+
+        return self
@@ -1,30 +1,150 @@
+import os
+import shutil
+import uuid
+from os import PathLike
+from typing import Callable
+
 import torch
 
+from attributor import get_logger
+from attributor.span import Span
+
+logger = get_logger()
+
+
+class TokenIndex:
+    """
+    An index of the ngram_size-grams of a [len] tokens tensor that finds many token sequences
+    at once, each allowing up to tolerance mismatched tokens.
+
+    A sequence with at most tolerance mismatches has an exactly matching gram among any
+    tolerance + 1 of its disjoint grams, so looking those up gives every candidate start. The
+    candidates of all sequences are then verified together. Sequences too short for that are
+    compared against every position instead.
+    """
+
+    def __init__(self, tokens: torch.Tensor, ngram_size: int = 4):
+        assert len(tokens.shape) == 1, "Only tokens tensors with rank 1 are supported"
+        self.tokens = tokens.cpu().type(torch.long)
+        self.ngram_size = ngram_size
+
+        if self.tokens.shape[0] >= ngram_size:
+            keys = self._hash(self.tokens.unsqueeze(0)).squeeze(0)
+        else:
+            keys = torch.empty(0, dtype=torch.long)
+        self.keys, self.positions = keys.sort()
+
+    def _hash(self, sequences: torch.Tensor) -> torch.Tensor:
+        """Hash of the gram starting at every position of [sequences, len], collisions are fine"""
+        grams = sequences.unfold(-1, self.ngram_size, 1)
+        return (grams * self._hash_weights()).sum(axis=-1)
+
+    def find_all(self, sequences: list[list[int]], tolerance: int = 5) -> list[int | None]:
+        """The first start of each sequence in tokens, or None if it can't be found"""
+        if not sequences:
+            return []
+
+        n = self.tokens.shape[0]
+        lengths = torch.tensor([len(sequence) for sequence in sequences], dtype=torch.long)
+        padded = torch.full((len(sequences), max(lengths.max().item(), 1)), -1, dtype=torch.long)
+        for i, sequence in enumerate(sequences):
+            padded[i, : len(sequence)] = torch.as_tensor(sequence, dtype=torch.long)
+
+        indexed = (lengths // self.ngram_size > tolerance) & (n >= self.ngram_size)
+        candidates = [self._indexed_candidates(padded, lengths, indexed, tolerance)]
+        for i in torch.argwhere(~indexed & (lengths <= n)).squeeze(-1).tolist():
+            starts = torch.arange(n - lengths[i].item() + 1)
+            candidates.append((torch.full_like(starts, i), starts))
+        sequence_ids = torch.cat([c[0] for c in candidates])
+        starts = torch.cat([c[1] for c in candidates])
+
+        # Count the mismatches of every candidate at once
+        offsets = torch.arange(padded.shape[1])
+        windows = self.tokens[(starts.unsqueeze(-1) + offsets).clamp_max(n - 1)]
+        valid = offsets < lengths[sequence_ids].unsqueeze(-1)
+        mismatches = ((windows != padded[sequence_ids]) & valid).sum(axis=-1)
+
+        # The first good start of every sequence
+        first = torch.full((len(sequences),), n, dtype=torch.long)
+        good = mismatches <= tolerance
+        first.scatter_reduce_(0, sequence_ids[good], starts[good], reduce="amin")
+        return [None if start == n else start for start in first.tolist()]
+
+    def _indexed_candidates(self, padded, lengths, indexed, tolerance):
+        n = self.tokens.shape[0]
+        if not indexed.any():
+            return torch.empty(0, dtype=torch.long), torch.empty(0, dtype=torch.long)
+
+        # tolerance + 1 disjoint grams of every indexed sequence
+        gram_offsets = torch.arange(tolerance + 1) * self.ngram_size
+        sequence_ids = torch.argwhere(indexed).squeeze(-1)
+        grams = padded[sequence_ids].unfold(-1, self.ngram_size, self.ngram_size)
+        grams = grams[:, : tolerance + 1]
+        keys = (grams * self._hash_weights()).sum(axis=-1)
+
+        left = torch.searchsorted(self.keys, keys.flatten(), side="left")
+        right = torch.searchsorted(self.keys, keys.flatten(), side="right")
+        counts = right - left
+        # Every indexed position whose gram matches, as (gram, position) pairs
+        gram_ids = torch.repeat_interleave(torch.arange(len(counts)), counts)
+        ranks = torch.arange(counts.sum()) - torch.repeat_interleave(
+            counts.cumsum(0) - counts, counts
+        )
+        positions = self.positions[left[gram_ids] + ranks]
+
+        candidate_sequence_ids = sequence_ids[gram_ids // (tolerance + 1)]
+        starts = positions - gram_offsets[gram_ids % (tolerance + 1)]
+        inside = (starts >= 0) & (starts + lengths[candidate_sequence_ids] <= n)
+        return candidate_sequence_ids[inside], starts[inside]
+
+    def _hash_weights(self):
+        return torch.tensor([1_000_003**i for i in range(self.ngram_size)], dtype=torch.long)
 
-def find(tokens: torch.Tensor, subtokens: torch.Tensor, tolerance=5):
-    assert len(tokens.shape) == 1, "Only tokens tensors with rank 1 are supported"
-    tokens_count = tokens.shape[0]
 
-    if not isinstance(subtokens, list):
+def encode_documents(tokenizer, documents: list[str]) -> list[list[int]]:
+    """Tokens of every document from one batched tokenizer call"""
+    return tokenizer(documents, add_special_tokens=False)["input_ids"]
+
+
+def find(tokens: torch.Tensor, subtokens: torch.Tensor, tolerance=5):
+    if isinstance(subtokens, torch.Tensor):
         assert (
             len(subtokens.shape) == 1
         ), "Only subtokens tensors with rank 1 are supported"
-        subtokens_count = subtokens.shape[0]
-    else:
-        subtokens_count = len(subtokens)
+        subtokens = subtokens.tolist()
+
+    assert len(subtokens) <= tokens.shape[0], "Subtokens must be smaller than tokens"
+
+    start = TokenIndex(tokens).find_all([subtokens], tolerance)[0]
+    if start is None:
+        raise IndexError("Subtokens not found in tokens")
+    return start, len(subtokens) - 1
 
-    assert subtokens_count <= tokens_count, "Subtokens must be smaller than tokens"
 
-    for i in range(tokens_count - subtokens_count):
-        score = 0
-        for j in range(subtokens_count):
-            if tokens[i + j] == subtokens[j]:
-                score += 1
-            elif j > tolerance and j - score > tolerance:
-                break
-        if subtokens_count - score <= tolerance:
-            return i, j
-    raise IndexError("Subtokens not found in tokens")
+def find_spans(
+    tokenizer, tokens: "torch.Tensor | TokenIndex", documents: list[str], tolerance: int = 5
+) -> list[Span]:
+    """
+    Locate each document in tokens, which may be a TokenIndex of them built before. Documents
+    that can't be found are skipped with a warning.
+    """
+    if not documents:
+        return []
+
+    index = tokens if isinstance(tokens, TokenIndex) else TokenIndex(tokens)
+    documents_tokens = encode_documents(tokenizer, documents)
+
+    spans = []
+    starts = index.find_all(documents_tokens, tolerance)
+    for document, document_tokens, start in zip(documents, documents_tokens, starts):
+        if start is not None:
+            end = start + len(document_tokens)
+            spans.append(
+                Span(start=start, end=end, step=1, window_size=len(document_tokens))
+            )
+        else:
+            logger.warning(f"Couldn't find document {document} in tokens.")
+    return spans
 
 
 def tokenize(tokenizer, messages, add_generation_prompt=False):
@@ -32,9 +152,85 @@ def tokenize(tokenizer, messages, add_generation_prompt=False):
         messages, tokenize=True, add_generation_prompt=add_generation_prompt, return_tensors="pt"
     )
 
+def tokenize_with_spans(
+    tokenizer,
+    messages,
+    character_spans: list[tuple[int, int]],
+    add_generation_prompt=False,
+) -> tuple[torch.Tensor, list[Span]]:
+    """
+    tokenize, and convert character spans [start, end) of the content of the last message into
+    the Spans of the tokens that overlap them, from the offsets of a fast tokenizer.
+    """
+    text = tokenizer.apply_chat_template(
+        messages, tokenize=False, add_generation_prompt=add_generation_prompt
+    )
+    content_start = text.rindex(messages[-1]["content"])
+    encoding = tokenizer(
+        text, add_special_tokens=False, return_offsets_mapping=True, return_tensors="pt"
+    )
+    spans = offsets_to_spans(encoding["offset_mapping"][0], character_spans, content_start)
+    return encoding["input_ids"], spans
+
+
+def offsets_to_spans(
+    offsets: torch.Tensor, character_spans: list[tuple[int, int]], content_start: int = 0
+) -> list[Span]:
+    """
+    The Spans of the tokens with [len, 2] character offsets that overlap each character span
+    [start, end), which start at content_start in the tokenized text.
+    """
+    character_spans = torch.tensor(character_spans, dtype=torch.long).reshape(-1, 2)
+    character_spans += content_start
+    # The first token ending after a span starts and the first token starting at its end
+    starts = torch.searchsorted(
+        offsets[:, 1].contiguous(), character_spans[:, 0].contiguous(), side="right"
+    )
+    ends = torch.searchsorted(
+        offsets[:, 0].contiguous(), character_spans[:, 1].contiguous(), side="left"
+    )
+
+    empty = character_spans[:, 1] <= character_spans[:, 0]
+
+    spans = []
+    for start, end, is_empty in zip(starts.tolist(), ends.tolist(), empty.tolist()):
+        if is_empty or end <= start:
+            # Empty documents get an empty span, so spans stay aligned with documents. Spans
+            # can't end at 0, so an empty span there is moved to 1, where it is just as empty.
+            start = end = max(start, 1)
+        spans.append(Span(start=start, end=end, step=1, window_size=max(end - start, 1)))
+    return spans
+
+
 def generate(model, tokenizer, generation_config, messages):
     prompt_tokens = tokenize(tokenizer, messages, add_generation_prompt=True)
     prompt_tokens = prompt_tokens.to(model.device)
     return model.generate(
         prompt_tokens, tokenizer=tokenizer, generation_config=generation_config
     )
+
+
+def atomic_write(path: PathLike, write: Callable[[str], None]):
+    """
+    Call write with a temporary path next to path, then move the file or directory it wrote to
+    path, so that concurrent runs never read a partial write. A file replaces any file already
+    at path, but a directory already at path was written by another run and is kept.
+    """
+    temporary_path = f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+    try:
+        write(temporary_path)
+        if os.path.isdir(temporary_path):
+            try:
+                os.rename(temporary_path, path)
+            except OSError:
+                # Saved by another process in the meantime
+                shutil.rmtree(temporary_path)
+        else:
+            os.replace(temporary_path, path)
+    except BaseException:
+        # Don't leave an interrupted write behind
+        if os.path.isdir(temporary_path):
+            shutil.rmtree(temporary_path)
+        elif os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
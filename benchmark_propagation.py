@@ -0,0 +1,116 @@
+import logging
+import time
+from argparse import ArgumentParser
+
+import torch
+from torch.profiler import ProfilerActivity, profile
+
+from attributor import get_logger, set_log_level
+from attributor.attributor import Attributor
+from attributor.propagation import FusedFlow
+
+logger = get_logger()
+
+
+def random_attention(heads: int, n: int, device) -> torch.Tensor:
+    scores = torch.randn(1, heads, n, n, device=device)
+    scores = scores.masked_fill(torch.ones(n, n, dtype=torch.bool, device=device).triu(1), -torch.inf)
+    return scores.softmax(-1)
+
+
+def count_allocations(fn, device) -> int:
+    activities = [ProfilerActivity.CPU]
+    if device.type == "cuda":
+        activities.append(ProfilerActivity.CUDA)
+
+    with profile(activities=activities, profile_memory=True) as profiler:
+        fn()
+    return sum(
+        1
+        for event in profiler.events()
+        if event.cpu_memory_usage > 0 or getattr(event, "device_memory_usage", 0) > 0
+    )
+
+
+def benchmark(name: str, propagate, attentions, attention_head_weights, device):
+    # Warm up, which also compiles
+    propagate(attentions[0], attention_head_weights[0])
+
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for attention, weights in zip(attentions, attention_head_weights):
+        propagate(attention, weights)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    seconds = (time.perf_counter() - start) / len(attentions)
+
+    allocations = count_allocations(
+        lambda: propagate(attentions[-1], attention_head_weights[-1]), device
+    )
+    logger.info(f"{name}: {seconds * 1000:.2f} ms and {allocations} allocations per layer")
+
+
+def main(args):
+    device = torch.device(args.device)
+    attributor = Attributor(None, None)
+
+    for n in args.lengths:
+        logger.info(f"Length {n}, {args.layers} layers of {args.heads} heads.")
+        attentions = [random_attention(args.heads, n, device) for _ in range(args.layers)]
+        attention_head_weights = [
+            torch.full((args.heads, 1, 1), 1 / args.heads, device=device)
+            for _ in range(args.layers)
+        ]
+
+        eager = {"Y": attributor._initial_state(n, device)}
+
+        def propagate_eager(attention, weights):
+            eager["Y"] = attributor.forward(eager["Y"], attention, weights)
+
+        benchmark("eager", propagate_eager, attentions, attention_head_weights, device)
+
+        for compiled in (False, True):
+            flow = FusedFlow(n, device, args.bucket_size, compiled=compiled)
+            benchmark(
+                "fused compiled" if compiled else "fused eager",
+                flow.fold_heads,
+                attentions,
+                attention_head_weights,
+                device,
+            )
+
+
+def get_args():
+    parser = ArgumentParser()
+    parser.add_argument("--lengths", type=int, nargs="+", default=[256, 1000, 2000])
+    parser.add_argument("--layers", type=int, default=8)
+    parser.add_argument("--heads", type=int, default=32)
+    parser.add_argument("--bucket_size", type=int, default=128)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        "--debug", action="store_const", const=logging.DEBUG, dest="log_level"
+    )
+    group.add_argument(
+        "--info", action="store_const", const=logging.INFO, dest="log_level"
+    )
+    group.add_argument(
+        "--warning", action="store_const", const=logging.WARNING, dest="log_level"
+    )
+    group.add_argument(
+        "--error", action="store_const", const=logging.ERROR, dest="log_level"
+    )
+
+    parser.set_defaults(log_level=logging.INFO)
+
+    args = parser.parse_args()
+
+    set_log_level(args.log_level)
+
+    return args
+
+
+if __name__ == "__main__":
+    main(get_args())
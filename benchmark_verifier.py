@@ -0,0 +1,167 @@
+import json
+import logging
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from attributor import get_logger, set_log_level
+from attributor.evaluation.async_verifier import AsyncOpenAIVerifier
+
+logger = get_logger()
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    A local stand-in for a chat completions endpoint that answers "Yes" after latency seconds
+    and records how many requests were in flight at once and when each of them arrived.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency: float):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.latency = latency
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.arrivals = []
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        server = self.server
+        with server._lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            server.arrivals.append(time.monotonic())
+
+        time.sleep(server.latency)
+        with server._lock:
+            server.in_flight -= 1
+
+        body = json.dumps(
+            {
+                "id": "stub",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": "stub",
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": "Yes"},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {"prompt_tokens": 100, "completion_tokens": 1, "total_tokens": 101},
+            }
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def max_in_window(arrivals: list[float], seconds: float) -> int:
+    """The most requests that arrived within any window of seconds"""
+    most = 0
+    start = 0
+    for end, arrival in enumerate(arrivals):
+        while arrival - arrivals[start] > seconds:
+            start += 1
+        most = max(most, end - start + 1)
+    return most
+
+
+def main(args):
+    # The OpenAI client's HTTP client logs every request
+    for name in ("httpx", "httpx2"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    server = StubServer(args.latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    verifier = AsyncOpenAIVerifier(
+        "stub",
+        base_url=server.base_url,
+        max_rpm=args.max_rpm,
+        max_tpm=None,
+        max_concurrency=args.max_concurrency,
+        burst_seconds=args.burst_seconds,
+    )
+    start = time.perf_counter()
+    futures = [verifier.submit("Paris", "Paris") for _ in range(args.requests)]
+    verifications = [future.result() for future in futures]
+    seconds = time.perf_counter() - start
+    verifier.close()
+    server.shutdown()
+
+    arrivals = sorted(server.arrivals)
+    burst = max(1, args.max_rpm / 60 * args.burst_seconds)
+    # A window of w seconds may hold the burst and w seconds of refills
+    allowed = burst + args.max_rpm / 60 * args.window + 1
+    busiest = max_in_window(arrivals, args.window)
+    logger.info(
+        f"{args.requests} verifications in {seconds:.2f} s, {server.max_in_flight} in flight at "
+        f"most, {busiest} requests in the busiest {args.window} s window (at most {allowed:.0f})."
+    )
+
+    failures = []
+    if not all(verifications):
+        failures.append("not every verification was parsed as yes")
+    if server.max_in_flight > args.max_concurrency:
+        failures.append(f"more than {args.max_concurrency} requests were in flight")
+    if busiest > allowed:
+        failures.append(f"more than {allowed:.0f} requests in {args.window} s")
+    for failure in failures:
+        logger.error(failure)
+    if failures:
+        sys.exit(1)
+
+
+def get_args():
+    parser = ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--max_concurrency", type=int, default=8)
+    parser.add_argument("--max_rpm", type=int, default=6000)
+    parser.add_argument("--burst_seconds", type=float, default=1.0)
+    parser.add_argument("--window", type=float, default=1.0)
+
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        "--debug", action="store_const", const=logging.DEBUG, dest="log_level"
+    )
+    group.add_argument(
+        "--info", action="store_const", const=logging.INFO, dest="log_level"
+    )
+    group.add_argument(
+        "--warning", action="store_const", const=logging.WARNING, dest="log_level"
+    )
+    group.add_argument(
+        "--error", action="store_const", const=logging.ERROR, dest="log_level"
+    )
+
+    parser.set_defaults(log_level=logging.INFO)
+
+    args = parser.parse_args()
+
+    set_log_level(args.log_level)
+
+    return args
+
+
+if __name__ == "__main__":
+    main(get_args())
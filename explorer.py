@@ -2,11 +2,19 @@ from flask import Flask, render_template, jsonify, request
 from pydantic import BaseModel
 from typing import List, Union
 import json
+import os
 
 from attributor.evaluation.evaluation_case import EvaluationCase, EvaluationResult
+from attributor.evaluation.result_log import ResultLog
+from attributor.attribution_store import AttributionStore
 
 app = Flask(__name__)
 
+# A store written by hotpot_qa.py --store_attributions, opened without a model
+attribution_store = None
+if os.environ.get('ATTRIBUTION_STORE'):
+    attribution_store = AttributionStore(os.environ['ATTRIBUTION_STORE'])
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -23,10 +31,31 @@ def process_file():
     
     if file:
         try:
-            data = json.load(file)
-            results = [EvaluationResult(**result) for result in data]
-            return jsonify([result.dict() for result in results])
+            if file.filename.endswith('.jsonl'):
+                # A result log written by Evaluator.evaluate, indexed like the attribution store
+                results = ResultLog.indexed_results(
+                    json.loads(line) for line in file if line.strip()
+                )
+            else:
+                data = json.load(file)
+                results = {i: EvaluationResult(**result) for i, result in enumerate(data)}
+            return jsonify([
+                {'index': index, **result.dict()} for index, result in results.items()
+            ])
         except json.JSONDecodeError:
             return jsonify({'error': 'Invalid JSON file'})
+
+@app.route('/attributions/<int:case_index>')
+def attributions(case_index):
+    if attribution_store is None or case_index not in attribution_store:
+        return jsonify({'error': 'No stored attribution'})
+
+    attribution = attribution_store.get(case_index)
+    return jsonify({
+        'tokens': attribution.tokens.tolist(),
+        'output_indices': attribution.output_indices.tolist(),
+        'attributions': attribution.attributions.tolist(),
+    })
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -1,24 +1,44 @@
+import hashlib
+import json
 import logging
 import os
+import sys
 from argparse import ArgumentParser
 from typing import Callable, Generic, Sequence, TypeVar
 
 import torch
-from datasets import load_dataset
+from datasets import load_dataset, load_from_disk
 from transformers import AutoModelForCausalLM, AutoTokenizer, GenerationConfig
 
 from attributor import get_logger, set_log_level
+from attributor.architectures import DEFAULT_CACHE_DIRPATH
+from attributor.attention_cache import AttentionCache
+from attributor.attribution_store import AttributionStore
 from attributor.attributor import Attributor
-from attributor.evaluation.evaluation_case import EvaluationCase
-from attributor.evaluation.evaluator import Evaluator
-from attributor.evaluation.openai_verifier import openai_verifier
+from attributor.evaluation.evaluation_case import EvaluationCase, FormattedCase
+from attributor.evaluation.evaluator import EvaluationProgress, Evaluator
+from attributor.evaluation.sharding import launch_shards, merge_shards, shard_dirpath
+from attributor.evaluation.sources import StreamingCases, sampled
+from attributor.evaluation.tokenized_cases import tokenize_cases
+from attributor.evaluation.verification_cache import CachedVerifier
+from attributor.evaluation.async_verifier import AsyncOpenAIVerifier
+from attributor.strategies import STRATEGIES
+from attributor.utils import atomic_write
 
 logger = get_logger()
 
+HOTPOT_QA_PATH = "hotpotqa/hotpot_qa"
+HOTPOT_QA_NAME = "fullwiki"
+HOTPOT_QA_SPLIT = "train"
+# Bump whenever format_hotpot_qa_row changes, so that cached formatted cases are rebuilt
+FORMAT_VERSION = 1
+
 
 class HotpotQAEvaluationCase(EvaluationCase):
     context: str
     question: str
+    # Character range [start, end) of every document in context
+    document_character_spans: list[tuple[int, int]] = []
 
 
 TOriginal = TypeVar("TOriginal")
@@ -48,11 +68,23 @@ class TransformedSequence(Sequence, Generic[TOriginal, TTransformed]):
         raise NotImplementedError
 
 
-def load_hotpot_qa(trust_remote_code: bool = False):
-    ds_path = "hotpotqa/hotpot_qa"
-    ds_name = "fullwiki"
+def load_hotpot_qa(
+    trust_remote_code: bool = False,
+    streaming: bool = False,
+    data_files: list[str] | None = None,
+    revision: str | None = None,
+):
+    """HotpotQA, or rows in its format from local JSON data_files"""
+    if data_files:
+        return load_dataset("json", data_files=data_files, split="train", streaming=streaming)
+
     hotpot_qa = load_dataset(
-        ds_path, ds_name, split="train", trust_remote_code=trust_remote_code
+        HOTPOT_QA_PATH,
+        HOTPOT_QA_NAME,
+        split=HOTPOT_QA_SPLIT,
+        revision=revision,
+        trust_remote_code=trust_remote_code,
+        streaming=streaming,
     )
     return hotpot_qa
 
@@ -61,15 +93,18 @@ def format_hotpot_qa_row(row: dict) -> HotpotQAEvaluationCase:
     documents = dict(zip(row["context"]["title"], row["context"]["sentences"]))
     context = 'Documents:\n"""\n'
     document_sentences = []
+    document_character_spans = []
     for title, sentences in documents.items():
         context += title + ":"
         context += "\n"
         for sentence in sentences:
+            start = len(context) + len(sentence) - len(sentence.lstrip())
             # Append with any whitespace
             context += sentence
             # Strip whitespace before indexing
             sentence = sentence.strip()
             document_sentences.append(sentence)
+            document_character_spans.append((start, start + len(sentence)))
         context += "\n\n"
 
     context = context.strip()
@@ -96,10 +131,170 @@ def format_hotpot_qa_row(row: dict) -> HotpotQAEvaluationCase:
         supporting_documents=supporting_sentences,
         context=context,
         question=row["question"],
+        document_character_spans=document_character_spans,
+    )
+
+
+def format_hotpot_qa_columns(row: dict) -> dict:
+    return format_hotpot_qa_row(row).model_dump()
+
+
+def hotpot_qa_cache_key(
+    data_files: list[str] | None = None, revision: str | None = None, **selection
+) -> str:
+    """
+    A filename-safe key of the formatted rows of HotpotQA at revision, or of data_files, and of
+    any selection of them such as limit or sample
+    """
+    if data_files:
+        source = [
+            (os.path.abspath(filepath), os.path.getsize(filepath), os.path.getmtime(filepath))
+            for filepath in data_files
+        ]
+    else:
+        source = [HOTPOT_QA_PATH, HOTPOT_QA_NAME, HOTPOT_QA_SPLIT, revision]
+    key = json.dumps(
+        {"source": source, "format_version": FORMAT_VERSION, **selection}, sort_keys=True
+    )
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def load_formatted_hotpot_qa(
+    trust_remote_code: bool = False,
+    data_files: list[str] | None = None,
+    revision: str | None = None,
+    num_proc: int | None = None,
+    cache_dirpath: str = DEFAULT_CACHE_DIRPATH,
+):
+    """
+    HotpotQA with every row formatted as a HotpotQAEvaluationCase, formatted once with num_proc
+    processes and then loaded from an Arrow dataset in cache_dirpath. Pin revision for the
+    cache to keep matching the rows on the hub.
+    """
+    dirpath = os.path.join(
+        cache_dirpath, "hotpot_qa", hotpot_qa_cache_key(data_files, revision)
+    )
+    if os.path.exists(dirpath):
+        return load_from_disk(dirpath)
+
+    hotpot_qa = load_hotpot_qa(
+        trust_remote_code=trust_remote_code, data_files=data_files, revision=revision
+    )
+
+    logger.info(f"Formatting HotPotQA into {dirpath}.")
+    formatted = hotpot_qa.map(
+        format_hotpot_qa_columns,
+        remove_columns=hotpot_qa.column_names,
+        num_proc=num_proc,
+        desc="Formatting",
+    )
+    atomic_write(dirpath, formatted.save_to_disk)
+    return load_from_disk(dirpath)
+
+
+def select_cases(dataset, limit: int | None = None, sample: float | None = None, seed: int = 0):
+    """The rows of dataset kept by sample, as StreamingCases keeps them, up to limit"""
+    if sample is not None:
+        dataset = dataset.select(
+            [i for i in range(len(dataset)) if sampled(i, sample, seed)]
+        )
+    if limit is not None:
+        dataset = dataset.select(range(min(limit, len(dataset))))
+    return dataset
+
+
+def format_case(case: HotpotQAEvaluationCase) -> FormattedCase:
+    return FormattedCase(
+        context=case.context,
+        document_character_spans=case.document_character_spans,
+    )
+
+
+def load_tokenizer(args):
+    logger.info(f"Loading tokenizer for {args.model}.")
+    tokenizer = AutoTokenizer.from_pretrained(
+        args.model, trust_remote_code=args.trust_remote_code
     )
 
+    if tokenizer.pad_token_id is None:
+        tokenizer.pad_token_id = tokenizer.eos_token_id
+    return tokenizer
+
+
+def load_evaluation_cases(args) -> Sequence[HotpotQAEvaluationCase]:
+    logger.info("Loading HotPotQA.")
+    if args.stream_dataset:
+        # Rows are downloaded and formatted only as they are evaluated
+        hotpot_qa = load_hotpot_qa(
+            trust_remote_code=args.trust_remote_code,
+            streaming=True,
+            data_files=args.data_files,
+            revision=args.revision,
+        )
+        splits = hotpot_qa.info.splits
+        return StreamingCases(
+            lambda offset: iter(hotpot_qa.skip(offset)),
+            format_hotpot_qa_row,
+            limit=args.limit,
+            sample=args.sample,
+            seed=args.seed,
+            length=splits["train"].num_examples if splits and "train" in splits else None,
+        )
+
+    hotpot_qa = load_formatted_hotpot_qa(
+        trust_remote_code=args.trust_remote_code,
+        data_files=args.data_files,
+        revision=args.revision,
+        num_proc=args.num_proc,
+    )
+    hotpot_qa = select_cases(hotpot_qa, args.limit, args.sample, args.seed)
+    return TransformedSequence(hotpot_qa, lambda row: HotpotQAEvaluationCase(**row))
+
+
+def load_tokenized_cases(args, tokenizer, evaluation_cases: Sequence[HotpotQAEvaluationCase]):
+    return tokenize_cases(
+        tokenizer,
+        evaluation_cases,
+        format_case,
+        hotpot_qa_cache_key(
+            args.data_files,
+            args.revision,
+            limit=args.limit,
+            sample=args.sample,
+            seed=args.seed,
+        ),
+    )
+
+
+def log_merged(progress: EvaluationProgress):
+    logger.info(f"Merged {progress.support} results of {progress.iteration} cases.")
+    for k in progress.mean_recall:
+        logger.info(f"Mean Recall @ {k}: {progress.mean_recall[k]:.1%}")
+        logger.info(f"Mean Precision @ {k}: {progress.mean_precision[k]:.1%}")
+
 
 def main(args):
+    progress_dirpath = os.path.join("evaluation_results", args.model, "hotpot_qa")
+
+    if args.merge:
+        log_merged(merge_shards(progress_dirpath, args.num_shards))
+        return
+
+    if args.num_shards > 1 and args.shard_index is None:
+        if not args.stream_dataset:
+            # Build the caches once here, so that the shards only read them
+            evaluation_cases = load_evaluation_cases(args)
+            if args.tokenized_cache:
+                load_tokenized_cases(args, load_tokenizer(args), evaluation_cases)
+
+        # Run every shard in its own process on this machine, then merge them
+        exit_codes = launch_shards([sys.executable, *sys.argv], args.num_shards, args.devices)
+        if any(exit_codes):
+            logger.error(f"Shards exited with {exit_codes}, not merging.")
+            return
+        log_merged(merge_shards(progress_dirpath, args.num_shards))
+        return
+
     torch_dtype = getattr(torch, args.dtype)
 
     logger.info(
@@ -110,16 +305,11 @@ def main(args):
         device_map=args.device_map,
         torch_dtype=torch_dtype,
         trust_remote_code=args.trust_remote_code,
-        attn_implementation="eager",
+        # Attentions are recomputed from queries and keys, so the fast kernel can be used
+        attn_implementation="sdpa" if args.recompute_attention else "eager",
     )
 
-    logger.info(f"Loading tokenizer for {args.model}.")
-    tokenizer = AutoTokenizer.from_pretrained(
-        args.model, trust_remote_code=args.trust_remote_code
-    )
-
-    if tokenizer.pad_token_id is None:
-        tokenizer.pad_token_id = tokenizer.eos_token_id
+    tokenizer = load_tokenizer(args)
 
     logger.info(f"Loading generation config for {args.model}.")
     generation_config = GenerationConfig.from_pretrained(
@@ -129,37 +319,89 @@ def main(args):
         do_sample=False,
     )
 
-    attributor = Attributor(model, tokenizer)
+    attributor = Attributor(
+        model,
+        tokenizer,
+        streaming=args.streaming,
+        recompute_attention=args.recompute_attention,
+        propagation=args.propagation,
+        sparse_top_k=args.sparse_top_k,
+        sparse_top_p=args.sparse_top_p,
+        compiled=args.compiled,
+        attention_cache=(
+            AttentionCache(
+                model,
+                max_bytes=int(args.attention_cache_gb * 2**30),
+                # Strategies reduce heads with their own weights
+                per_head=args.attention_cache_per_head or bool(args.strategies),
+            )
+            if args.attention_cache
+            else None
+        ),
+    )
 
-    logger.info("Loading HotPotQA.")
-    hotpot_qa = load_hotpot_qa(trust_remote_code=args.trust_remote_code)
-    evaluation_cases = TransformedSequence(hotpot_qa, format_hotpot_qa_row)
+    evaluation_cases = load_evaluation_cases(args)
 
-    progress_dirpath = os.path.join("evaluation_results", args.model, "hotpot_qa")
     if args.overwrite:
         os.rmdir(progress_dirpath)
 
-    def format(case: HotpotQAEvaluationCase):
-        return case.context
-
-    def verifier(*verifier_args, **verifier_kwargs):
-        return openai_verifier(
-            *verifier_args, openai_client=args.openai_api_key, **verifier_kwargs
+    verifier = None
+    if args.verify:
+        # Verifications run in the background and are filled in before progress is saved
+        verifier = AsyncOpenAIVerifier(
+            args.openai_api_key,
+            base_url=args.openai_base_url,
+            max_rpm=args.max_rpm,
+            max_tpm=args.max_tpm,
+            max_concurrency=args.max_concurrent_verifications,
+        )
+        if args.verification_cache_filepath:
+            verifier = CachedVerifier(verifier, args.verification_cache_filepath)
+
+    tokenized_cases = None
+    if args.tokenized_cache and not args.stream_dataset:
+        tokenized_cases = load_tokenized_cases(args, tokenizer, evaluation_cases)
+
+    evaluator_dirpath = shard_dirpath(progress_dirpath, args.num_shards, args.shard_index or 0)
+    attribution_store = None
+    if args.store_attributions:
+        attribution_store = AttributionStore(
+            os.path.join(evaluator_dirpath, "attributions"),
+            mode="a",
+            dtype=args.attribution_dtype,
         )
 
     evaluator = Evaluator(
         attributor=attributor,
-        formatter=format,
-        progress_dirpath=progress_dirpath,
-        # verifier=verifier,
+        formatter=format_case,
+        progress_dirpath=evaluator_dirpath,
+        grouped_attribution=args.grouped_attribution,
+        strategies=[STRATEGIES[name]() for name in args.strategies or []],
+        verifier=verifier,
+        attribution_store=attribution_store,
     )
 
     evaluator.evaluate(
         cases=evaluation_cases,
+        max_context_tokens=args.max_context_tokens,
+        tokenized_cases=tokenized_cases,
+        max_batch_tokens=args.max_batch_tokens,
+        prefetch=args.prefetch,
+        prepare_workers=args.prepare_workers,
+        postprocess_depth=args.postprocess_depth,
+        postprocess_workers=args.postprocess_workers,
+        checkpoint_every=args.checkpoint_every,
+        checkpoint_seconds=args.checkpoint_seconds,
+        num_shards=args.num_shards,
+        shard_index=args.shard_index or 0,
         # generation_config=generation_config,
-        # max_context_tokens=args.max_context_tokens,
     )
 
+    if verifier is not None:
+        verifier.close()
+    if attribution_store is not None:
+        attribution_store.close()
+
 
 def get_args():
     parser = ArgumentParser()
@@ -171,6 +413,54 @@ def get_args():
     parser.add_argument("--trust_remote_code", default=False, action="store_true")
     parser.add_argument("--overwrite", default=False, action="store_true")
     parser.add_argument("--openai_api_key", default=None)
+    parser.add_argument("--openai_base_url", default=None)
+    parser.add_argument("--verify", default=False, action="store_true")
+    parser.add_argument("--max_rpm", type=int, default=500)
+    parser.add_argument("--max_tpm", type=int, default=200_000)
+    parser.add_argument("--max_concurrent_verifications", type=int, default=32)
+    parser.add_argument(
+        "--verification_cache_filepath",
+        default=os.path.join("evaluation_results", "verifications.sqlite"),
+    )
+    parser.add_argument("--streaming", default=False, action="store_true")
+    parser.add_argument("--grouped_attribution", default=False, action="store_true")
+    parser.add_argument("--recompute_attention", default=False, action="store_true")
+    parser.add_argument(
+        "--propagation", choices=["dense", "triangular", "packed"], default="dense"
+    )
+    parser.add_argument("--sparse_top_k", type=int, default=None)
+    parser.add_argument("--sparse_top_p", type=float, default=None)
+    parser.add_argument("--max_batch_tokens", type=int, default=None)
+    parser.add_argument("--compiled", default=False, action="store_true")
+    parser.add_argument("--attention_cache", default=False, action="store_true")
+    parser.add_argument("--attention_cache_gb", type=float, default=64)
+    parser.add_argument("--attention_cache_per_head", default=False, action="store_true")
+    parser.add_argument("--strategies", nargs="+", choices=list(STRATEGIES), default=None)
+    parser.add_argument("--prefetch", type=int, default=0)
+    parser.add_argument("--prepare_workers", type=int, default=1)
+    parser.add_argument("--postprocess_depth", type=int, default=0)
+    parser.add_argument("--postprocess_workers", type=int, default=1)
+    parser.add_argument("--checkpoint_every", type=int, default=100)
+    parser.add_argument("--checkpoint_seconds", type=float, default=300)
+    # Without --shard_index, all shards are launched locally and merged
+    parser.add_argument("--num_shards", type=int, default=1)
+    parser.add_argument("--shard_index", type=int, default=None)
+    parser.add_argument("--devices", nargs="+", default=None)
+    parser.add_argument("--merge", default=False, action="store_true")
+    parser.add_argument("--stream_dataset", default=False, action="store_true")
+    # Local JSON files of rows in the HotpotQA format, such as data/hotpot_qa_sample.jsonl,
+    # instead of HotpotQA itself
+    parser.add_argument("--data_files", nargs="+", default=None)
+    parser.add_argument("--revision", default=None)
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--sample", type=float, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--num_proc", type=int, default=None)
+    parser.add_argument("--tokenized_cache", default=False, action="store_true")
+    parser.add_argument("--store_attributions", default=False, action="store_true")
+    parser.add_argument(
+        "--attribution_dtype", choices=["float32", "float16", "uint8"], default="float16"
+    )
 
     group = parser.add_mutually_exclusive_group()
     group.add_argument(
@@ -1,6 +1,6 @@
 import torch
-from transformers import LlamaForCausalLM
 
+from attributor.architectures import get_attention_head_weights
 from server.models import AttentionHead, Layer, Model
 
 
@@ -12,17 +12,9 @@ class Attributor:
 
     def _get_attention_head_weights(self):
         if self._attention_head_weights is None:
-            if isinstance(self.model, LlamaForCausalLM):
-                output_projections = [layer.self_attn.o_proj.weight for layer in self.model.model.layers]
-                per_head_output_projections = [o_proj.reshape(self.model.config.num_attention_heads, -1, o_proj.shape[-1]) for o_proj in output_projections]
-                attention_head_weights = [torch.linalg.matrix_norm(o_proj.type(torch.float32), dim=[1,2]).unsqueeze(-1).unsqueeze(-1) for o_proj in per_head_output_projections]
-                self._attention_head_weights = [a / a.sum() for a in attention_head_weights]
-                
-            else:
-                raise NotImplementedError(type(self.model).__name__)
-        
+            self._attention_head_weights = get_attention_head_weights(self.model)
+
         return self._attention_head_weights
-        
 
     def attend(self, tokens: torch.Tensor):
         assert len(tokens.shape) == 1, "Only tokens tensors with rank 1 are supported"